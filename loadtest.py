@@ -0,0 +1,349 @@
+# loadtest.py
+# Офлайн навантажувальний тест: справжній Application з main.py проти локального фейкового Bot API
+# та заглушки Gemini. Приклад: python loadtest.py --rate 100 --duration 30 --storage sqlite
+import argparse
+import asyncio
+import builtins
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+BOT_ID = 999000
+BOT_USERNAME = "LoadTestBot"
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": BOT_USERNAME}
+ADMIN_RIGHTS = {
+    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+    "can_manage_video_chats": True, "can_restrict_members": True, "can_promote_members": False,
+    "can_change_info": True, "can_invite_users": True, "can_post_stories": False,
+    "can_edit_stories": False, "can_delete_stories": False, "can_pin_messages": True
+}
+DEFAULT_MIX = "text=70,mention=10,plus=8,minus=4,mute=3,callback=5"
+def make_user(user_id):
+    """Словник користувача для фейкових оновлень"""
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+def percentile(values, q):
+    """Перцентиль q (0..1) відсортованого списку"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+# === ФЕЙКОВИЙ BOT API ===
+class FakeBotApi:
+    """Локальний HTTP-сервер, що відповідає на методи Bot API як справжній Telegram"""
+    def __init__(self, admins, latency):
+        self.admins = admins
+        self.latency = latency
+        self.calls = Counter()
+        self.next_message_id = 10 ** 6
+        self.loop = None
+        self.stopped = None
+        self.sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        self.port = self.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True)
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+    def message(self, params, text=None):
+        """Відповідь на send*/edit*: повідомлення від бота у вказаний чат"""
+        self.next_message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        chat = {"id": chat_id, "type": "private", "first_name": "User"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"}
+        return {
+            "message_id": int(params.get("message_id", self.next_message_id)),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": BOT_USER,
+            "text": text if text is not None else params.get("text", params.get("caption", ""))
+        }
+    def answer(self, method, params):
+        """Результат виклику методу (поле result відповіді Telegram)"""
+        method = method.lower()
+        if method == "getme":
+            return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=True, supports_inline_queries=False)
+        if method in ("sendmessage", "sendanimation", "sendphoto", "editmessagetext", "editmessagereplymarkup"):
+            return self.message(params)
+        if method == "getchatadministrators":
+            return [dict(ADMIN_RIGHTS, status="administrator", user=make_user(admin_id)) for admin_id in self.admins] + [
+                dict(ADMIN_RIGHTS, status="administrator", user=BOT_USER)]
+        if method == "getchatmember":
+            user_id = int(params.get("user_id", 0))
+            if user_id in self.admins:
+                return dict(ADMIN_RIGHTS, status="administrator", user=make_user(user_id))
+            return {"status": "member", "user": make_user(user_id)}
+        if method == "getchat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"}
+        # deleteMessage(s), restrictChatMember, answerCallbackQuery, sendChatAction, ...
+        return True
+    async def _serve(self):
+        api = self
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                params = {name: values[0].decode() for name, values in self.request.body_arguments.items()}
+                if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+                    params = json.loads(self.request.body)
+                api.calls[method] += 1
+                if api.latency:
+                    await asyncio.sleep(api.latency)
+                self.write({"ok": True, "result": api.answer(method, params)})
+            get = post
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)]))
+        server.add_sockets(self.sockets)
+        await self.stopped.wait()
+        server.stop()
+    def start(self):
+        self.thread.start()
+        while self.stopped is None:
+            time.sleep(0.01)
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join(timeout=5)
+# === ЗАГЛУШКА GEMINI ===
+class StubModel:
+    """Замінює genai.GenerativeModel: відповідає з фіксованою затримкою, з потоковим режимом або без"""
+    def __init__(self, latency, chunks=4):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+    async def generate_content_async(self, prompt, stream=False):
+        self.calls += 1
+        if stream:
+            return self._stream()
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(text=f"Відповідь заглушки на {len(prompt)} символів запиту.")
+    async def _stream(self):
+        for i in range(self.chunks):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(text=f"частина {i + 1} ")
+# === ГЕНЕРАТОР ТРАФІКУ ===
+class TrafficGenerator:
+    """Створює JSON-оновлення Telegram у заданих пропорціях"""
+    def __init__(self, chats, users, admins, mix, seed):
+        self.random = random.Random(seed)
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = [1000 + i for i in range(users)]
+        self.admins = admins
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.update_id = 0
+        self.message_id = 0
+        self.counts = Counter()
+    def _message(self, chat_id, user_id, text, reply_to=None):
+        self.message_id += 1
+        chat = {"id": chat_id, "type": "private", "first_name": f"User{user_id}"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"}
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": chat, "from": make_user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to:
+            message["reply_to_message"] = reply_to
+        return message
+    def _reply_target(self, chat_id, sender):
+        """Повідомлення іншого учасника, на яке відповідають"""
+        target = self.random.choice([u for u in self.users if u != sender])
+        return self._message(chat_id, target, "звичайне повідомлення")
+    def next_update(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        self.counts[kind] += 1
+        self.update_id += 1
+        chat_id = self.random.choice(self.chats)
+        user_id = self.random.choice(self.users)
+        if kind == "mention":
+            message = self._message(chat_id, user_id, f"@{BOT_USERNAME} питання номер {self.random.randint(1, 50)}")
+        elif kind in ("plus", "minus"):
+            message = self._message(chat_id, user_id, "+" if kind == "plus" else "-", self._reply_target(chat_id, user_id))
+        elif kind == "mute":
+            admin_id = self.random.choice(self.admins)
+            message = self._message(chat_id, admin_id, "/mute 5m флуд", self._reply_target(chat_id, admin_id))
+        elif kind == "callback":
+            admin_id = self.random.choice(self.admins)
+            menu = self._message(admin_id, admin_id, "Меню")
+            menu["from"] = BOT_USER
+            return {"update_id": self.update_id, "callback_query": {
+                "id": str(self.update_id), "from": make_user(admin_id), "chat_instance": str(admin_id),
+                "data": "show_groups", "message": menu}}
+        else:
+            message = self._message(chat_id, user_id, f"повідомлення {self.update_id} " + "слово " * self.random.randint(1, 20))
+        return {"update_id": self.update_id, "message": message}
+# === ЗБІР МЕТРИК ===
+class HandlerStats:
+    """Затримки обробників, затримка черги та незавершені виклики"""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.enqueued = {}
+        self.queue_lag = []
+        self.started = 0
+        self.last_started = None
+        self.in_flight = 0
+    def wrap(self, callback):
+        name = callback.__name__
+        async def timed(update, context):
+            enqueued_at = self.enqueued.pop(getattr(update, "update_id", None), None)
+            if enqueued_at is not None:
+                self.queue_lag.append(time.perf_counter() - enqueued_at)
+                self.started += 1
+                self.last_started = time.perf_counter()
+            self.in_flight += 1
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                if type(e).__name__ != "ApplicationHandlerStop":
+                    self.errors[name] += 1
+                raise
+            finally:
+                self.latencies[name].append(time.perf_counter() - start)
+                self.in_flight -= 1
+        return timed
+    def instrument(self, app):
+        """Обгортає кожен обробник таблиці, не змінюючи її порядку"""
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = self.wrap(handler.callback)
+class DiskWriteCounter:
+    """Рахує байти, записані main.py через open() (JSON, журнал розмов)"""
+    def __init__(self):
+        self.bytes = 0
+    def open(self, file, mode="r", *args, **kwargs):
+        f = builtins.open(file, mode, *args, **kwargs)
+        if any(flag in mode for flag in "wax+"):
+            counter = self
+            write = f.write
+            def counted_write(data):
+                counter.bytes += len(data.encode("utf-8") if isinstance(data, str) else data)
+                return write(data)
+            f.write = counted_write
+        return f
+def sqlite_size(path):
+    """Розмір бази SQLite разом з WAL-журналом"""
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+# === ЗАПУСК ===
+async def run(args, api):
+    import main as bot
+    stub = StubModel(args.gemini_latency / 1000)
+    bot.model = stub
+    # Обробники перевіряють наявність ключа, а не моделі
+    bot.GEMINI_API_KEY = "loadtest"
+    disk = DiskWriteCounter()
+    bot.open = disk.open
+    stats = HandlerStats()
+    app = bot.build_application()
+    stats.instrument(app)
+    errors = Counter()
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+    app.add_error_handler(count_error)
+    generator = TrafficGenerator(args.chats, args.users, args.admins, args.mix, args.seed)
+    total = int(args.rate * args.duration)
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+    sqlite_before = sqlite_size(bot.SQLITE_FILE)
+    print(f"🚀 {total} оновлень зі швидкістю {args.rate:g}/с, Bot API: {api.url}, сховище: {bot.STORAGE_BACKEND}")
+    from telegram import Update
+    started_at = time.perf_counter()
+    for i in range(total):
+        delay = started_at + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(generator.next_update(), app.bot)
+        stats.enqueued[update.update_id] = time.perf_counter()
+        await app.update_queue.put(update)
+    # Чекаємо, доки всі оновлення (разом з block=False обробниками) завершаться
+    deadline = time.perf_counter() + args.drain_timeout
+    settled = 0
+    while settled < 3 and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+        idle = stats.started >= total and not stats.in_flight and app.update_queue.empty()
+        settled = settled + 1 if idle else 0
+    elapsed = time.perf_counter() - started_at
+    await app.stop()
+    await bot.post_shutdown(app)
+    await app.shutdown()
+    written = disk.bytes
+    if bot.STORAGE_BACKEND == "sqlite":
+        written += max(0, sqlite_size(bot.SQLITE_FILE) - sqlite_before)
+    intake = (stats.last_started or time.perf_counter()) - started_at
+    report(args, total, elapsed, intake, generator, stats, errors, api, stub, written)
+def report(args, total, elapsed, intake, generator, stats, errors, api, stub, written):
+    """Друкує підсумки тесту"""
+    processed = stats.started
+    print("\n📊 Результати навантажувального тесту")
+    print(f"Трафік: " + ", ".join(f"{kind}={count}" for kind, count in generator.counts.most_common()))
+    print(f"Прийнято в обробку {processed} з {total} оновлень за {intake:.2f} с: {processed / max(intake, 1e-9):.1f} оновлень/с (ціль {args.rate:g}/с)")
+    # block=False обробники можуть ще чекати ліміту групи після того, як оновлення прийняте
+    print(f"Усі обробники завершились за {elapsed:.2f} с")
+    lag = sorted(stats.queue_lag)
+    print(f"Затримка в черзі оновлень: p50 {percentile(lag, 0.5) * 1000:.1f} мс, p99 {percentile(lag, 0.99) * 1000:.1f} мс")
+    print(f"\n{'Обробник':<28}{'викликів':>10}{'p50 мс':>10}{'p99 мс':>10}{'помилок':>10}")
+    for name, values in sorted(stats.latencies.items()):
+        values.sort()
+        print(f"{name:<28}{len(values):>10}{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}{stats.errors[name]:>10}")
+    if errors:
+        print("Помилки обробників: " + ", ".join(f"{name}={count}" for name, count in errors.most_common()))
+    print("\nЗапити до Bot API: " + ", ".join(f"{method}={count}" for method, count in api.calls.most_common()))
+    print(f"Виклики Gemini: {stub.calls}")
+    print(f"Записано на диск: {written} байт ({written / max(processed, 1):.1f} байт/оновлення)")
+def parse_mix(value):
+    """'text=70,mention=10' -> {'text': 70.0, 'mention': 10.0}"""
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("text", "mention", "plus", "minus", "mute", "callback"):
+            raise argparse.ArgumentTypeError(f"Невідомий тип трафіку: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн навантажувальний тест бота")
+    parser.add_argument("--rate", type=float, default=50, help="оновлень за секунду")
+    parser.add_argument("--duration", type=float, default=20, help="тривалість подачі трафіку, с")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"пропорції трафіку ({DEFAULT_MIX})")
+    parser.add_argument("--chats", type=int, default=5, help="кількість груп")
+    parser.add_argument("--users", type=int, default=200, help="кількість учасників")
+    parser.add_argument("--admins", type=int, default=3, help="кількість адмінів")
+    parser.add_argument("--api-latency", type=float, default=20, help="затримка фейкового Bot API, мс")
+    parser.add_argument("--gemini-latency", type=float, default=800, help="затримка заглушки Gemini, мс")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json", help="STORAGE_BACKEND")
+    parser.add_argument("--telegram-limits", action="store_true", help="залишити реальні ліміти Telegram в обмежувачі")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="скільки чекати завершення обробки, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", help="каталог для файлів даних (за замовчуванням тимчасовий)")
+    args = parser.parse_args()
+    admins = [1 + i for i in range(args.admins)]
+    args.admins = admins
+    api = FakeBotApi(admins, args.api_latency / 1000)
+    api.start()
+    # Налаштування main.py читаються при імпорті - виставляємо до нього
+    os.environ["BOT_TOKEN"] = f"{BOT_ID}:LOADTEST"
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ.pop("GEMINI_API_KEY", None)
+    os.environ.setdefault("METRICS_PORT", "0")
+    if not args.telegram_limits:
+        for name in ("RATE_LIMIT_GLOBAL_PER_SECOND", "RATE_LIMIT_PRIVATE_PER_SECOND"):
+            os.environ.setdefault(name, "100000")
+        os.environ.setdefault("RATE_LIMIT_GROUP_PER_MINUTE", "6000000")
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="loadtest-")
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+    try:
+        asyncio.run(run(args, api))
+    finally:
+        api.stop()
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+if __name__ == "__main__":
+    main()
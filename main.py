@@ -1,100 +1,1630 @@
 # bot.py
 import os
 import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
 import re
+import shutil
+import sqlite3
 from datetime import datetime, timedelta, timezone
-from telegram import Update, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, ChatMember, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     ContextTypes,
+    BaseRateLimiter,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters
 )
 import google.generativeai as genai
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from dotenv import load_dotenv
 import asyncio
+import atexit
+import bisect
+import contextlib
+import copy
+import contextvars
+import functools
+import hashlib
+import heapq
+import time
+from collections import OrderedDict, deque
 # Завантажуємо змінні з .env
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not BOT_TOKEN:
     raise ValueError("Не вдалося завантажити BOT_TOKEN з .env файлу")
+# Режим отримання оновлень: "polling" (за замовчуванням) або "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Налаштування webhook: локальна адреса сервера, шлях і секрет (заголовок X-Telegram-Bot-Api-Secret-Token)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Публічна HTTPS-адреса, яку бот реєструє в Telegram (setWebhook), наприклад https://bot.example.com/telegram за reverse proxy;
+# обов'язкова в режимі webhook - локальну адресу сервера Telegram не приймає
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Адреса Bot API (наприклад, локальний telegram-bot-api сервер для тестів); без неї - api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# === ЛОГУВАННЯ ===
+# Загальний рівень і рівні окремих підсистем, наприклад LOG_LEVELS="bot.deletions=WARNING,httpx=INFO"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING,apscheduler=WARNING")
+# Частка записів рівня INFO і нижче, що потрапляють у лог, наприклад LOG_SAMPLE_RATES="bot.deletions=0.1"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+# "json" - один JSON-об'єкт на рядок, "text" - для читання в консолі
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_CONTEXT_FIELDS = ("handler", "chat_id", "user_id")
+log = logging.getLogger("bot")
+ai_log = logging.getLogger("bot.ai")
+storage_log = logging.getLogger("bot.storage")
+api_log = logging.getLogger("bot.api")
+mute_log = logging.getLogger("bot.mutes")
+deletion_log = logging.getLogger("bot.deletions")
+# Обробник, чат і користувач поточного оновлення - підставляються в кожен запис
+log_context = contextvars.ContextVar("log_context", default={})
+log_listener = None
+def parse_log_settings(value):
+    """'bot.ai=DEBUG,httpx=WARNING' -> {'bot.ai': 'DEBUG', 'httpx': 'WARNING'}"""
+    settings = {}
+    for part in value.split(","):
+        name, sep, setting = part.partition("=")
+        if sep and name.strip():
+            settings[name.strip()] = setting.strip()
+    return settings
+class SamplingFilter(logging.Filter):
+    """Пропускає лише частку записів рівня INFO і нижче від вказаних логерів"""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        return rate is None or record.levelno > logging.INFO or random.random() < rate
+class LogContextFilter(logging.Filter):
+    """Доповнює запис полями з контексту оновлення, якщо їх не передано через extra"""
+    def filter(self, record):
+        context = log_context.get()
+        for field in LOG_CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get(field))
+        return True
+class JsonFormatter(logging.Formatter):
+    """Запис як один рядок JSON: час, рівень, логер, повідомлення і контекст"""
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, що не вклеює traceback у повідомлення: він іде в exc_text і форматується в потоці запису"""
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Сам traceback (з кадрами стеку) у чергу не передаємо - лише його текст
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+def setup_logging():
+    """Записи лише кладуться в чергу, у stdout їх пише окремий потік - цикл подій не чекає на консоль"""
+    global log_listener
+    if log_listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(handler)s chat=%(chat_id)s user=%(user_id)s] %(message)s"))
+    queue_handler = LogQueueHandler(queue.SimpleQueue())
+    # Фільтри обробника виконуються в потоці, що пише запис, - там, де доступний контекст оновлення
+    queue_handler.addFilter(SamplingFilter({name: float(rate) for name, rate in parse_log_settings(LOG_SAMPLE_RATES).items()}))
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_log_settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+    log_listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    log_listener.start()
+    # Дописуємо чергу до кінця при виході
+    atexit.register(log_listener.stop)
+# === МЕТРИКИ ===
+# Локальний HTTP-ендпоінт /metrics у текстовому форматі Prometheus (METRICS_PORT=0 - вимкнено)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Межі кошиків гістограм затримок (в секундах)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+def format_labels(labels):
+    """(('method', 'sendMessage'),) -> '{method="sendMessage"}'"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+class MetricsRegistry:
+    """Лічильники, гістограми та значення, що обчислюються під час запиту /metrics"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # name -> (тип, опис)
+        self.meta = {}
+        # name -> {мітки: значення} для лічильників, {мітки: [кошики, сума, кількість]} для гістограм
+        self.values = {}
+        # name -> функція, що повертає число або список (мітки, значення)
+        self.collectors = {}
+    def register(self, name, kind, help_text, collect=None):
+        self.meta[name] = (kind, help_text)
+        if collect is None:
+            self.values[name] = {}
+        else:
+            self.collectors[name] = collect
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values[name]
+        series[key] = series.get(key, 0) + amount
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values[name]
+        entry = series.get(key)
+        if entry is None:
+            entry = series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+    def render(self):
+        """Усі метрики у текстовому форматі Prometheus 0.0.4"""
+        lines = []
+        for name, (kind, help_text) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.collectors:
+                try:
+                    collected = self.collectors[name]()
+                except Exception as e:
+                    log.warning("Не вдалося зібрати метрику %s: %s", name, e)
+                    continue
+                if not isinstance(collected, list):
+                    collected = [((), collected)]
+                for labels, value in collected:
+                    lines.append(f"{name}{format_labels(tuple(sorted(dict(labels).items())))} {value}")
+            elif kind == "histogram":
+                for key, (counts, total, count) in self.values[name].items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {total}")
+                    lines.append(f"{name}_count{format_labels(key)} {count}")
+            else:
+                for key, value in self.values[name].items():
+                    lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+metrics = MetricsRegistry(METRICS_BUCKETS)
+metrics.register("bot_handler_latency_seconds", "histogram", "Тривалість обробників оновлень")
+metrics.register("bot_handler_errors_total", "counter", "Винятки в обробниках оновлень")
+metrics.register("bot_telegram_api_latency_seconds", "histogram", "Тривалість запитів до Bot API за методом")
+metrics.register("bot_telegram_api_errors_total", "counter", "Помилки запитів до Bot API за методом і типом")
+metrics.register("bot_gemini_latency_seconds", "histogram", "Тривалість викликів Gemini (без очікування в черзі)")
+metrics.register("bot_gemini_errors_total", "counter", "Невдалі виклики Gemini")
+metrics.register("bot_gemini_prompt_tokens_total", "counter", "Оцінка токенів у запитах до Gemini")
+metrics.register("bot_gemini_reply_tokens_total", "counter", "Оцінка токенів у відповідях Gemini")
+metrics.register("bot_persistence_flush_seconds", "histogram", "Тривалість запису даних на диск за сховищем")
+# === ПРОФІЛЮВАННЯ ОНОВЛЕНЬ ===
+# Початковий стан (далі перемикається з адмін-меню), поріг повільного оновлення і файл з розбивкою
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+PROFILE_FILE = os.getenv("PROFILE_FILE", "slow_updates.log")
+PROFILE_FILE_MAX_BYTES = int(os.getenv("PROFILE_FILE_MAX_BYTES", str(5 * 1024 * 1024)))
+PROFILE_FILE_BACKUPS = int(os.getenv("PROFILE_FILE_BACKUPS", "3"))
+# Відрізки поточного запуску обробника: [(тип, назва, початок, тривалість)] або None, якщо профілювання вимкнене
+profile_trace = contextvars.ContextVar("profile_trace", default=None)
+@contextlib.contextmanager
+def profile_span(kind, name):
+    """Вимірює відрізок всередині обробника (API, диск, модель); без профілювання нічого не робить"""
+    trace = profile_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.append((kind, name, started, time.monotonic() - started))
+class UpdateProfiler:
+    """Збирає відрізки кожного запуску обробника і записує повільні у файл з ротацією"""
+    def __init__(self, enabled, slow_ms, filename, max_bytes, backups):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.slow_updates = 0
+        self.logger = None
+    def _get_logger(self):
+        # Файл пише окремий потік, як і основний лог
+        if self.logger is None:
+            file_handler = logging.handlers.RotatingFileHandler(self.filename, maxBytes=self.max_bytes, backupCount=self.backups, encoding="utf-8")
+            queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+            listener = logging.handlers.QueueListener(queue_handler.queue, file_handler)
+            listener.start()
+            atexit.register(listener.stop)
+            self.logger = logging.getLogger("bot.profiler.slow_updates")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(queue_handler)
+        return self.logger
+    def start(self):
+        """Новий список відрізків або None, якщо профілювання вимкнене"""
+        return [] if self.enabled else None
+    def finish(self, trace, started, handler, update):
+        """Записує запуск обробника, якщо він тривав довше за поріг"""
+        total = time.monotonic() - started
+        if total * 1000 < self.slow_ms:
+            return
+        self.slow_updates += 1
+        by_kind = {}
+        for kind, _, _, duration in trace:
+            by_kind[kind] = by_kind.get(kind, 0) + duration
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        entry = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "handler": handler,
+            "update_id": getattr(update, "update_id", None),
+            "chat_id": chat.id if chat else None,
+            "user_id": user.id if user else None,
+            "total_ms": round(total * 1000, 1),
+            "by_kind_ms": {kind: round(duration * 1000, 1) for kind, duration in by_kind.items()},
+            "spans": [
+                {"kind": kind, "name": name, "start_ms": round((span_start - started) * 1000, 1), "duration_ms": round(duration * 1000, 1)}
+                for kind, name, span_start, duration in trace
+            ],
+        }
+        self._get_logger().info(json.dumps(entry, ensure_ascii=False, default=str))
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        log.info("Профілювання оновлень %s", "увімкнено" if enabled else "вимкнено")
+profiler = UpdateProfiler(PROFILING_ENABLED, PROFILE_SLOW_MS, PROFILE_FILE, PROFILE_FILE_MAX_BYTES, PROFILE_FILE_BACKUPS)
+def instrument_handlers(application):
+    """Обгортає кожен зареєстрований обробник вимірюванням часу, лічильником помилок, контекстом логів і профілюванням"""
+    def wrap(callback):
+        name = callback.__name__
+        @functools.wraps(callback)
+        async def measured(update, context):
+            chat = getattr(update, "effective_chat", None)
+            user = getattr(update, "effective_user", None)
+            token = log_context.set({"handler": name, "chat_id": chat.id if chat else None, "user_id": user.id if user else None})
+            trace = profiler.start()
+            trace_token = profile_trace.set(trace)
+            started = time.monotonic()
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception:
+                metrics.inc("bot_handler_errors_total", handler=name)
+                raise
+            finally:
+                metrics.observe("bot_handler_latency_seconds", time.monotonic() - started, handler=name)
+                log_context.reset(token)
+                profile_trace.reset(trace_token)
+                if trace is not None:
+                    profiler.finish(trace, started, name, update)
+        return measured
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = wrap(handler.callback)
 # Налаштування Gemini
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
     model = genai.GenerativeModel('gemini-2.5-flash-lite')
 else:
      model = None # Без ключа ИИ не будет работать, но бот запустится
+# Максимальна кількість одночасних запитів до Gemini і тайм-аут одного запиту (в секундах)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+# Запобіжник для Gemini: частка помилок за вікно, після якої запити тимчасово не надсилаються
+GEMINI_BREAKER_FAILURE_RATE = float(os.getenv("GEMINI_BREAKER_FAILURE_RATE", "0.5"))
+GEMINI_BREAKER_MIN_CALLS = int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "5"))
+GEMINI_BREAKER_WINDOW = float(os.getenv("GEMINI_BREAKER_WINDOW", "60"))
+# Скільки секунд запобіжник відкритий, перш ніж пропустити пробний запит
+GEMINI_BREAKER_OPEN_SECONDS = float(os.getenv("GEMINI_BREAKER_OPEN_SECONDS", "30"))
+GEMINI_UNAVAILABLE_REPLY = "🤖 Зараз я трохи перевантажений і не можу відповісти. Спробуй ще раз за хвилину."
+class CircuitOpenError(Exception):
+    """Запит не надіслано: запобіжник відкритий"""
+class CircuitBreaker:
+    """Запобіжник: closed -> open (забагато помилок) -> half_open (пробний запит) -> closed"""
+    def __init__(self, failure_rate, min_calls, window, open_seconds):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_started = None
+        # (час, успіх) для викликів у межах вікна
+        self.calls = deque()
+        self.rejected = 0
+        self.times_opened = 0
+    def _trim(self, now):
+        while self.calls and now - self.calls[0][0] > self.window:
+            self.calls.popleft()
+    def _open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.probe_started = None
+        self.calls.clear()
+        self.times_opened += 1
+        ai_log.warning("Gemini недоступний - запобіжник відкрито на %g с", self.open_seconds)
+    def allow(self):
+        """Чи можна зараз надіслати запит (у half_open - лише один пробний)"""
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.open_seconds:
+            self.state = "half_open"
+            self.probe_started = None
+        if self.state == "half_open":
+            # Пробний запит, що завис (наприклад, скасований), не блокує запобіжник назавжди
+            if self.probe_started is None or now - self.probe_started > GEMINI_TIMEOUT * 2:
+                self.probe_started = now
+                return True
+        elif self.state == "closed":
+            return True
+        self.rejected += 1
+        return False
+    def record_success(self):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self.state = "closed"
+            self.probe_started = None
+            self.calls.clear()
+        self.calls.append((now, True))
+        self._trim(now)
+    def record_failure(self):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._open(now)
+            return
+        self.calls.append((now, False))
+        self._trim(now)
+        failures = sum(1 for _, ok in self.calls if not ok)
+        if len(self.calls) >= self.min_calls and failures / len(self.calls) >= self.failure_rate:
+            self._open(now)
+    def stats(self):
+        self._trim(time.monotonic())
+        return {
+            "state": self.state,
+            "window_calls": len(self.calls),
+            "window_failures": sum(1 for _, ok in self.calls if not ok),
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+gemini_breaker = CircuitBreaker(
+    GEMINI_BREAKER_FAILURE_RATE,
+    GEMINI_BREAKER_MIN_CALLS,
+    GEMINI_BREAKER_WINDOW,
+    GEMINI_BREAKER_OPEN_SECONDS
+)
+def record_gemini_tokens(prompt, reply_text, mode):
+    """Оцінка токенів успішного виклику (SDK не повертає точних лічильників)"""
+    metrics.inc("bot_gemini_prompt_tokens_total", estimate_tokens(prompt), mode=mode)
+    metrics.inc("bot_gemini_reply_tokens_total", estimate_tokens(reply_text), mode=mode)
+async def generate_ai_reply(prompt):
+    """Асинхронно отримує відповідь від Gemini з обмеженням паралельності і тайм-аутом"""
+    if not gemini_breaker.allow():
+        raise CircuitOpenError(GEMINI_UNAVAILABLE_REPLY)
+    try:
+        async with gemini_semaphore:
+            started = time.monotonic()
+            try:
+                with profile_span("gemini", "generate_content"):
+                    response = await asyncio.wait_for(model.generate_content_async(prompt), timeout=GEMINI_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Gemini не відповів за {GEMINI_TIMEOUT:g} с")
+            finally:
+                metrics.observe("bot_gemini_latency_seconds", time.monotonic() - started, mode="single")
+        reply_text = response.text.strip()
+    except Exception:
+        gemini_breaker.record_failure()
+        metrics.inc("bot_gemini_errors_total", mode="single")
+        raise
+    gemini_breaker.record_success()
+    record_gemini_tokens(prompt, reply_text, "single")
+    return reply_text
 # Файли для зберігання даних
 DATA_FILE = "bot_data.json"
 CONVERSATIONS_FILE = "conversations.json"
 # === ФУНКЦІЇ ДЛЯ РОБОТИ З ФАЙЛАМИ ===
+def read_json_file(filename):
+    """Читає JSON-файл (помилки обробляє load_json)"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
 def load_json(filename):
-    """Завантажує JSON з файлу"""
+    """Завантажує JSON з файлу, а якщо він пошкоджений - з останнього вдалого знімка"""
+    backup_name = f"{filename}.bak"
     if os.path.exists(filename):
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return read_json_file(filename)
+        except Exception as e:
+            storage_log.warning("Помилка завантаження %s: %s", filename, e)
+    if os.path.exists(backup_name):
+        try:
+            data = read_json_file(backup_name)
+            storage_log.warning("Дані %s відновлено з %s", filename, backup_name)
+            return data
         except Exception as e:
-            print(f"⚠️ Помилка завантаження {filename}: {e}")
-            return {}
+            storage_log.error("Помилка завантаження %s: %s", backup_name, e)
     return {}
-def save_json(filename, data):
-    """Зберігає дані в JSON-файл"""
+@profile_span("disk", "write_file_atomic")
+def write_file_atomic(filename, payload):
+    """Атомарно записує текст у файл: тимчасовий файл + fsync + перейменування.
+    Попередня версія файлу зберігається як останній вдалий знімок (.bak)"""
+    tmp_name = f"{filename}.tmp"
+    backup_name = f"{filename}.bak"
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filename):
+            # Знімок робимо, не прибираючи сам файл: ціль змінює лише остання os.replace
+            backup_tmp = f"{backup_name}.tmp"
+            if os.path.exists(backup_tmp):
+                os.remove(backup_tmp)
+            try:
+                os.link(filename, backup_tmp)
+            except OSError:
+                # Файлова система без жорстких посилань - копіюємо
+                shutil.copy2(filename, backup_tmp)
+            os.replace(backup_tmp, backup_name)
+        os.replace(tmp_name, filename)
+        # Фіксуємо перейменування в каталозі (на Windows каталог не відкрити - пропускаємо)
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+        return True
     except Exception as e:
-        print(f"⚠️ Помилка збереження {filename}: {e}")
+        storage_log.error("Помилка збереження %s: %s", filename, e)
+        return False
+# === ВІДКЛАДЕНЕ ЗБЕРЕЖЕННЯ (WRITE-BEHIND) ===
+# Інтервал (в секундах), з яким змінені дані скидаються на диск
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", "5"))
+class WriteBehindStore:
+    """Накопичує зміни в пам'яті і скидає їх на диск не частіше ніж раз на інтервал"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = None
+        self.dirty = False
+        self._lock = asyncio.Lock()
+    def mark_dirty(self, data, table=None, *keys):
+        """Позначає дані зміненими (без запису на диск); JSON-файл усе одно пишеться цілком"""
+        self.data = data
+        self.dirty = True
+    async def flush(self):
+        """Скидає накопичені зміни на диск, якщо вони є"""
+        if not self.dirty or self.data is None:
+            return
+        async with self._lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            started = time.monotonic()
+            # Серіалізуємо в циклі подій (дані не змінюються під час dumps), пишемо в потоці
+            try:
+                payload = json.dumps(self.data, ensure_ascii=False, indent=2, default=str)
+            except Exception as e:
+                storage_log.error("Помилка збереження %s: %s", self.filename, e)
+                self.dirty = True
+                return
+            if not await asyncio.to_thread(write_file_atomic, self.filename, payload):
+                self.dirty = True
+                return
+            metrics.observe("bot_persistence_flush_seconds", time.monotonic() - started, store="json")
+    def load(self):
+        return load_json(self.filename)
+    def close(self):
+        pass
+# === SQLITE-СХОВИЩЕ ДЛЯ BOT_DATA ===
+# Бекенд зберігання bot_data: "json" (bot_data.json) або "sqlite" (SQLITE_FILE)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = os.getenv("SQLITE_FILE", "bot_data.db")
+# Ключі, що колись потрапили в bot_data помилково (наприклад, функція, збережена через default=str)
+STALE_BOT_DATA_KEYS = {"schedule_message_deletion"}
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    chat_id INTEGER PRIMARY KEY,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS muted_users (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    until TEXT,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS muted_users_until ON muted_users (until);
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    profile TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS profiles_username ON profiles (username COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS reputations (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    length INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS reputations_ranking ON reputations (chat_id, length DESC);
+CREATE TABLE IF NOT EXISTS pending_deletions (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    deadline REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS pending_deletions_deadline ON pending_deletions (deadline);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+# Таблиця -> (колонки, кількість колонок первинного ключа)
+SQLITE_TABLES = {
+    "groups": (("chat_id", "title"), 1),
+    "muted_users": (("chat_id", "user_id", "username", "until"), 2),
+    "profiles": (("user_id", "username", "first_name", "profile", "created_at"), 1),
+    "reputations": (("chat_id", "user_id", "length"), 2),
+    "pending_deletions": (("chat_id", "message_id", "deadline"), 2),
+    "settings": (("key", "value"), 1),
+}
+def bot_data_to_rows(data):
+    """Розкладає bot_data на рядки таблиць: {таблиця: {первинний ключ: рядок}}"""
+    rows = {table: {} for table in SQLITE_TABLES}
+    for chat_id, group_data in data.get("groups", {}).items():
+        rows["groups"][(int(chat_id),)] = (int(chat_id), group_data.get("title"))
+    for chat_id, users in data.get("muted_users", {}).items():
+        for user_id, muted in users.items():
+            rows["muted_users"][(int(chat_id), int(user_id))] = (int(chat_id), int(user_id), muted.get("username"), muted.get("until"))
+    for user_id, profile_data in data.get("profiles", {}).items():
+        rows["profiles"][(int(user_id),)] = (
+            int(user_id),
+            profile_data.get("username"),
+            profile_data.get("first_name"),
+            profile_data.get("profile"),
+            profile_data.get("created_at")
+        )
+    for chat_id, chat_scores in data.get("reputations", {}).items():
+        if not isinstance(chat_scores, dict):
+            continue
+        for user_id, length in chat_scores.items():
+            rows["reputations"][(int(chat_id), int(user_id))] = (int(chat_id), int(user_id), length)
+    for deadline, chat_id, message_id in data.get("pending_deletions", []):
+        rows["pending_deletions"][(int(chat_id), int(message_id))] = (int(chat_id), int(message_id), float(deadline))
+    for key, value in data.items():
+        if key in SQLITE_TABLES or key in STALE_BOT_DATA_KEYS:
+            continue
+        rows["settings"][(key,)] = (key, json.dumps(value, ensure_ascii=False, default=str))
+    return rows
+def bot_data_table_changes(data, table, keys):
+    """Поточні рядки таблиці для змінених ключів: (рядки для запису, ключі видалених записів)"""
+    upserts = []
+    deletes = []
+    if table == "pending_deletions":
+        # Черга видалень - купа-список, тож індексуємо її один раз на всі ключі
+        deadlines = {(int(chat_id), int(message_id)): float(deadline) for deadline, chat_id, message_id in data.get("pending_deletions", [])}
+    for key in keys:
+        row = None
+        if table == "settings":
+            if key[0] in data:
+                row = (key[0], json.dumps(data[key[0]], ensure_ascii=False, default=str))
+        elif table == "pending_deletions":
+            if key in deadlines:
+                row = (*key, deadlines[key])
+        elif table == "groups":
+            group_data = data.get("groups", {}).get(str(key[0]))
+            if group_data is not None:
+                row = (key[0], group_data.get("title"))
+        elif table == "profiles":
+            profile_data = data.get("profiles", {}).get(str(key[0]))
+            if profile_data is not None:
+                row = (
+                    key[0],
+                    profile_data.get("username"),
+                    profile_data.get("first_name"),
+                    profile_data.get("profile"),
+                    profile_data.get("created_at")
+                )
+        elif table == "muted_users":
+            muted = data.get("muted_users", {}).get(str(key[0]), {}).get(str(key[1]))
+            if muted is not None:
+                row = (*key, muted.get("username"), muted.get("until"))
+        elif table == "reputations":
+            length = data.get("reputations", {}).get(str(key[0]), {}).get(str(key[1]))
+            if length is not None:
+                row = (*key, length)
+        if row is None:
+            deletes.append(key)
+        else:
+            upserts.append(row)
+    return upserts, deletes
+class SqliteStorage:
+    """Зберігає bot_data в SQLite (WAL) і при скиданні записує тільки змінені рядки"""
+    def __init__(self, filename, legacy_json_file):
+        self.filename = filename
+        self.legacy_json_file = legacy_json_file
+        self.data = None
+        # Таблиця -> первинні ключі рядків, змінених з останнього скидання
+        self.dirty_keys = {}
+        # Зміна без вказаних ключів - наступне скидання перезапише всі таблиці
+        self.full_sync = False
+        self.conn = None
+        self._lock = asyncio.Lock()
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SQLITE_SCHEMA)
+        return self.conn
+    def mark_dirty(self, data, table=None, *keys):
+        """Позначає змінені рядки таблиці (без запису на диск); без table - усі дані"""
+        self.data = data
+        if table is None:
+            self.full_sync = True
+            return
+        if table != "settings":
+            keys = [tuple(int(part) for part in key) for key in keys]
+        self.dirty_keys.setdefault(table, set()).update(keys)
+    def _is_empty(self):
+        conn = self.connect()
+        return not any(conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in SQLITE_TABLES)
+    @profile_span("disk", "sqlite_write")
+    def _write(self, upserts, deletes, replace=False):
+        conn = self.connect()
+        with conn:
+            if replace:
+                for table in SQLITE_TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+            for table, table_rows in upserts.items():
+                columns, _ = SQLITE_TABLES[table]
+                placeholders = ", ".join("?" for _ in columns)
+                conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", table_rows)
+            for table, keys in deletes.items():
+                columns, pk_len = SQLITE_TABLES[table]
+                condition = " AND ".join(f"{column} = ?" for column in columns[:pk_len])
+                conn.executemany(f"DELETE FROM {table} WHERE {condition}", keys)
+    def migrate_from_json(self):
+        """Одноразово переносить дані з bot_data.json у порожню базу"""
+        data = load_json(self.legacy_json_file)
+        if not data:
+            return False
+        convert_legacy_reputations(data.setdefault("reputations", {}))
+        rows = bot_data_to_rows(data)
+        self._write({table: list(table_rows.values()) for table, table_rows in rows.items()}, {})
+        storage_log.info("Дані перенесено з %s у %s", self.legacy_json_file, self.filename)
+        return True
+    def load(self):
+        """Завантажує bot_data з бази у тому ж вигляді, що й з JSON"""
+        conn = self.connect()
+        if self._is_empty() and os.path.exists(self.legacy_json_file):
+            self.migrate_from_json()
+        data = {}
+        for chat_id, title in conn.execute("SELECT chat_id, title FROM groups"):
+            data.setdefault("groups", {})[str(chat_id)] = {"title": title}
+        for chat_id, user_id, username, until in conn.execute("SELECT chat_id, user_id, username, until FROM muted_users"):
+            data.setdefault("muted_users", {}).setdefault(str(chat_id), {})[str(user_id)] = {"username": username, "until": until}
+        for user_id, username, first_name, profile, created_at in conn.execute(
+            "SELECT user_id, username, first_name, profile, created_at FROM profiles"
+        ):
+            data.setdefault("profiles", {})[str(user_id)] = {
+                "username": username,
+                "first_name": first_name,
+                "profile": profile,
+                "created_at": created_at
+            }
+        for chat_id, user_id, length in conn.execute("SELECT chat_id, user_id, length FROM reputations"):
+            data.setdefault("reputations", {}).setdefault(str(chat_id), {})[str(user_id)] = length
+        # Відсортований за часом список - уже коректна купа
+        data["pending_deletions"] = [
+            [deadline, chat_id, message_id]
+            for chat_id, message_id, deadline in conn.execute(
+                "SELECT chat_id, message_id, deadline FROM pending_deletions ORDER BY deadline"
+            )
+        ]
+        for key, value in conn.execute("SELECT key, value FROM settings"):
+            data[key] = json.loads(value)
+        return data
+    def _restore_dirty(self, dirty_keys, full_sync):
+        """Повертає незаписані зміни, щоб наступне скидання їх повторило"""
+        self.full_sync = self.full_sync or full_sync
+        for table, keys in dirty_keys.items():
+            self.dirty_keys.setdefault(table, set()).update(keys)
+    async def flush(self):
+        """Записує в базу тільки рядки, позначені через mark_dirty"""
+        if not (self.dirty_keys or self.full_sync) or self.data is None:
+            return
+        async with self._lock:
+            dirty_keys, full_sync = self.dirty_keys, self.full_sync
+            self.dirty_keys, self.full_sync = {}, False
+            if not (dirty_keys or full_sync):
+                return
+            started = time.monotonic()
+            upserts = {}
+            deletes = {}
+            try:
+                if full_sync:
+                    upserts = {table: list(table_rows.values()) for table, table_rows in bot_data_to_rows(self.data).items()}
+                else:
+                    for table, keys in dirty_keys.items():
+                        upserts[table], deletes[table] = bot_data_table_changes(self.data, table, keys)
+            except Exception as e:
+                storage_log.error("Помилка збереження %s: %s", self.filename, e)
+                self._restore_dirty(dirty_keys, full_sync)
+                return
+            try:
+                await asyncio.to_thread(self._write, upserts, deletes, full_sync)
+                metrics.observe("bot_persistence_flush_seconds", time.monotonic() - started, store="sqlite")
+            except Exception as e:
+                storage_log.error("Помилка збереження %s: %s", self.filename, e)
+                self._restore_dirty(dirty_keys, full_sync)
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+if STORAGE_BACKEND == "sqlite":
+    bot_data_store = SqliteStorage(SQLITE_FILE, DATA_FILE)
+else:
+    bot_data_store = WriteBehindStore(DATA_FILE)
 # === ФУНКЦІЇ ДЛЯ РОБОТИ З КОНТЕКСТОМ ===
 async def get_user_name(user):
     """Отримує ім'я користувача"""
     return user.first_name or user.username or f"Користувач {user.id}"
-async def get_conversation_context(user_id):
-    """Отримує контекст розмови користувача"""
-    conversations = load_json(CONVERSATIONS_FILE)
-    user_conv = conversations.get(str(user_id), {})
-    return user_conv.get("history", [])
+# === ІСТОРІЯ РОЗМОВ (ПАМ'ЯТЬ + ЖУРНАЛ) ===
+# Журнал нових кроків розмови (JSON Lines), періодично згортається в CONVERSATIONS_FILE
+CONVERSATIONS_JOURNAL = "conversations.journal"
+# Скільки останніх повідомлень зберігаємо для кожного користувача
+CONVERSATION_HISTORY_LIMIT = 10
+# Інтервал (в секундах) згортання журналу в основний файл
+CONVERSATIONS_COMPACT_INTERVAL = float(os.getenv("CONVERSATIONS_COMPACT_INTERVAL", "300"))
+class ConversationStore:
+    """Зберігає історію розмов у пам'яті; на диск дописує тільки нові кроки"""
+    def __init__(self, snapshot_file, journal_file, limit):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.limit = limit
+        self.conversations = {}
+        self.journal_entries = 0
+        self._lock = asyncio.Lock()
+    def _apply(self, user_id, user_name, messages):
+        conv = self.conversations.get(user_id)
+        if conv is None:
+            conv = self.conversations[user_id] = {"name": user_name, "history": deque(maxlen=self.limit), "summary": ""}
+        conv["name"] = user_name
+        conv["history"].extend(messages)
+        return conv
+    def _apply_fold(self, user_id, summary, drop):
+        conv = self.conversations.get(user_id)
+        if conv is None:
+            return
+        conv["summary"] = summary
+        for _ in range(min(drop, len(conv["history"]))):
+            conv["history"].popleft()
+    def _write_journal(self, entry):
+        try:
+            with profile_span("disk", "conversation_journal"), open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.journal_entries += 1
+        except Exception as e:
+            storage_log.error("Помилка запису журналу %s: %s", self.journal_file, e)
+    def _replay(self, filename):
+        """Відтворює кроки з журналу поверх знімка"""
+        if not os.path.exists(filename):
+            return 0
+        count = 0
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    if "summary" in entry:
+                        self._apply_fold(entry["user_id"], entry["summary"], entry["drop"])
+                    else:
+                        self._apply(entry["user_id"], entry["name"], entry["messages"])
+                    count += 1
+                except Exception:
+                    # Обірваний останній рядок після аварійної зупинки - пропускаємо
+                    continue
+        return count
+    def load(self):
+        """Завантажує знімок і відтворює журнал"""
+        self.conversations = {}
+        for user_id, conv in load_json(self.snapshot_file).items():
+            self._apply(user_id, conv.get("name", ""), conv.get("history", []))["summary"] = conv.get("summary", "")
+        # Журнал, що згортався під час зупинки, відтворюємо першим
+        self.journal_entries = self._replay(f"{self.journal_file}.compacting")
+        self.journal_entries += self._replay(self.journal_file)
+    def get_history(self, user_id):
+        conv = self.conversations.get(str(user_id))
+        return list(conv["history"]) if conv else []
+    def get_summary(self, user_id):
+        conv = self.conversations.get(str(user_id))
+        return conv["summary"] if conv else ""
+    def append(self, user_id, user_name, user_message, bot_response):
+        """Додає крок розмови в пам'ять і дописує його в журнал"""
+        messages = [user_message, bot_response]
+        self._apply(str(user_id), user_name, messages)
+        self._write_journal({"user_id": str(user_id), "name": user_name, "messages": messages})
+    def fold(self, user_id, folded_messages, summary):
+        """Замінює найстаріші повідомлення історії на підсумок розмови"""
+        conv = self.conversations.get(str(user_id))
+        if conv is None:
+            return
+        # Поки готувався підсумок, частину згорнутих повідомлень могло вже витіснити з кільця
+        history = conv["history"]
+        drop = 0
+        for message in folded_messages:
+            if drop < len(history) and history[drop] == message:
+                drop += 1
+        self._apply_fold(str(user_id), summary, drop)
+        self._write_journal({"user_id": str(user_id), "summary": summary, "drop": drop})
+    async def compact(self):
+        """Записує повний знімок історії і очищує журнал"""
+        if not self.journal_entries:
+            return
+        async with self._lock:
+            # Нові кроки під час запису знімка підуть у свіжий журнал
+            compacting_file = f"{self.journal_file}.compacting"
+            if os.path.exists(compacting_file) and os.path.exists(self.journal_file):
+                # Попереднє згортання не вдалося - об'єднуємо журнали
+                with open(compacting_file, 'a', encoding='utf-8') as dst, open(self.journal_file, 'r', encoding='utf-8') as src:
+                    dst.write(src.read())
+                os.remove(self.journal_file)
+            elif os.path.exists(self.journal_file):
+                os.replace(self.journal_file, compacting_file)
+            self.journal_entries = 0
+            started = time.monotonic()
+            payload = json.dumps(
+                {
+                    user_id: {"name": conv["name"], "history": list(conv["history"]), "summary": conv["summary"]}
+                    for user_id, conv in self.conversations.items()
+                },
+                ensure_ascii=False, indent=2
+            )
+            if await asyncio.to_thread(write_file_atomic, self.snapshot_file, payload):
+                if os.path.exists(compacting_file):
+                    os.remove(compacting_file)
+                metrics.observe("bot_persistence_flush_seconds", time.monotonic() - started, store="conversations")
+            else:
+                self.journal_entries += 1
+conversation_store = ConversationStore(CONVERSATIONS_FILE, CONVERSATIONS_JOURNAL, CONVERSATION_HISTORY_LIMIT)
 async def save_conversation_step(user_id, user_message, bot_response, user_name):
     """Зберігає крок розмови"""
-    conversations = load_json(CONVERSATIONS_FILE)
-    if str(user_id) not in conversations:
-        conversations[str(user_id)] = {
-            "name": user_name,
-            "history": []
-        }
-    conv = conversations[str(user_id)]
-    conv["name"] = user_name
-    conv["history"].extend([user_message, bot_response])
-    # Зберігаємо тільки останні 10 повідомлень
-    if len(conv["history"]) > 10:
-        conv["history"] = conv["history"][-10:]
-    save_json(CONVERSATIONS_FILE, conversations)
+    conversation_store.append(user_id, user_name, user_message, bot_response)
+async def compact_conversations_job(context: ContextTypes.DEFAULT_TYPE):
+    """Періодично згортає журнал розмов в основний файл"""
+    await conversation_store.compact()
+# === ПОБУДОВА ЗАПИТУ ДО GEMINI ===
+# Приблизний бюджет токенів на весь запит (персона + підсумок + історія + нове повідомлення)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+# Для оцінки без звернення до API: в середньому ~3 символи кирилиці на токен
+CHARS_PER_TOKEN = 3
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+# Префікс персони рахується один раз на кожну зміну персони
+personality_prefix_cache = {"personality": None, "prefix": "", "tokens": 0}
+def get_personality_prefix(personality):
+    """Повертає стабільний префікс запиту з персоною та його оцінку в токенах"""
+    if personality_prefix_cache["personality"] != personality:
+        prefix = f"{personality}\n"
+        personality_prefix_cache.update(personality=personality, prefix=prefix, tokens=estimate_tokens(prefix))
+    return personality_prefix_cache["prefix"], personality_prefix_cache["tokens"]
+def fit_history(history, budget):
+    """Повертає, скільки останніх повідомлень історії вміщується в бюджет (парами запит-відповідь)"""
+    used = 0
+    kept = 0
+    for i in range(len(history) - 1, -1, -1):
+        used += estimate_tokens(history[i]) + 1
+        if used > budget:
+            break
+        kept += 1
+    # Не розриваємо пару "користувач - асистент"
+    return kept - kept % 2 if kept < len(history) else kept
+def build_ai_prompt(user_id, personality, reply_context, user_line):
+    """Збирає запит: персона, підсумок старої розмови, останні повідомлення дослівно, новий запит"""
+    prefix, prefix_tokens = get_personality_prefix(personality)
+    summary = conversation_store.get_summary(user_id)
+    summary_text = f"Підсумок попередньої розмови: {summary}\n" if summary else ""
+    budget = PROMPT_TOKEN_BUDGET - prefix_tokens - estimate_tokens(summary_text) - estimate_tokens(reply_context) - estimate_tokens(user_line)
+    history = conversation_store.get_history(user_id)
+    recent = history[len(history) - fit_history(history, budget):] if budget > 0 else []
+    prompt = prefix + summary_text
+    if recent:
+        prompt += "Попередня розмова:\n" + "\n".join(recent) + "\n"
+    return prompt + reply_context + user_line
+# === КЕШ ВІДПОВІДЕЙ GEMINI ===
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+class ResponseCache:
+    """LRU-кеш відповідей з часом життя; ключ - нормалізований запит + хеш персони"""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    @staticmethod
+    def make_key(query, personality):
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+        personality_hash = hashlib.sha1(personality.encode('utf-8')).hexdigest()[:16]
+        return f"{personality_hash}:{normalized}"
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    def clear(self):
+        self.entries.clear()
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+def response_cache_key(user_id, personality, query, reply_context):
+    """Ключ кешу або None, якщо відповідь залежить від особистої історії чи контексту відповіді"""
+    # Навіть короткі "чому?" чи "продовжуй" залежать від розмови - кешуємо лише користувачів без історії
+    if reply_context or conversation_store.get_history(user_id) or conversation_store.get_summary(user_id):
+        return None
+    return response_cache.make_key(query, personality)
+# === ПОТОКОВІ ВІДПОВІДІ GEMINI ===
+# Потоковий режим: заглушка одразу, далі редагування в міру надходження тексту
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+# Мінімальний інтервал (в секундах) між редагуваннями потокових відповідей в одному чаті - спільний для всіх
+# потоків чату: 3 с - 20 редагувань/хв, ліміт групи
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "3"))
+STREAM_PLACEHOLDER = "✍️ ..."
+TELEGRAM_MESSAGE_LIMIT = 4096
+# chat_id -> момент, з якого в чаті можна наступне редагування потокової відповіді
+stream_edit_clock = {}
+def delay_stream_edits(chat_id):
+    """Відкладає наступне редагування в чаті на STREAM_EDIT_INTERVAL (щойно надіслано повідомлення)"""
+    now = time.monotonic()
+    if len(stream_edit_clock) > 1000:
+        # Прибираємо чати, де слоти давно минули
+        for key in [key for key, slot in stream_edit_clock.items() if slot <= now]:
+            del stream_edit_clock[key]
+    stream_edit_clock[chat_id] = max(stream_edit_clock.get(chat_id, 0.0), now + STREAM_EDIT_INTERVAL)
+async def wait_stream_edit_slot(chat_id):
+    """Чекає, доки в чаті можна редагувати, і займає цей слот"""
+    while True:
+        # Слот займаємо лише перед самим редагуванням - скасований потік не тримає чужу чергу
+        now = time.monotonic()
+        slot = stream_edit_clock.get(chat_id, 0.0)
+        if slot <= now:
+            stream_edit_clock[chat_id] = now + STREAM_EDIT_INTERVAL
+            return
+        await asyncio.sleep(slot - now)
+async def stream_ai_reply(prompt, message):
+    """Надсилає заглушку у відповідь на message і редагує її частинами відповіді Gemini"""
+    if not gemini_breaker.allow():
+        raise CircuitOpenError(GEMINI_UNAVAILABLE_REPLY)
+    try:
+        placeholder = await message.reply_text(STREAM_PLACEHOLDER)
+    except Exception:
+        # Запит до Gemini так і не пішов - звільняємо можливий пробний слот
+        gemini_breaker.probe_started = None
+        raise
+    chat_id = message.chat_id
+    # Заглушка теж повідомлення в ліміті групи - займає слот, від якого рахуються редагування
+    delay_stream_edits(chat_id)
+    text = ""
+    shown = STREAM_PLACEHOLDER
+    updated = asyncio.Event()
+    async def editor():
+        """Показує найсвіжіший текст у слотах редагування чату, проміжні версії пропускає"""
+        nonlocal shown
+        while True:
+            await updated.wait()
+            await wait_stream_edit_slot(chat_id)
+            updated.clear()
+            visible = text[:TELEGRAM_MESSAGE_LIMIT].strip()
+            if visible and visible != shown:
+                try:
+                    await placeholder.edit_text(visible)
+                    shown = visible
+                except Exception as e:
+                    # Проміжне редагування не критичне - фінальне все одно буде
+                    ai_log.warning("Не вдалося оновити відповідь: %s", e)
+    async def consume():
+        nonlocal text
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            text += chunk.text
+            updated.set()
+    # Редагування йдуть окремою задачею: очікування Telegram не займає слот Gemini і не рахується в тайм-аут
+    editor_task = asyncio.create_task(editor())
+    try:
+        try:
+            async with gemini_semaphore:
+                started = time.monotonic()
+                try:
+                    with profile_span("gemini", "generate_content_stream"):
+                        await asyncio.wait_for(consume(), timeout=GEMINI_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Gemini не відповів за {GEMINI_TIMEOUT:g} с")
+                finally:
+                    metrics.observe("bot_gemini_latency_seconds", time.monotonic() - started, mode="stream")
+            text = text.strip()
+            if not text:
+                raise ValueError("Gemini повернув порожню відповідь")
+        except Exception:
+            # Запобіжник рахує лише збої моделі (виклик і читання частин), а не помилки Telegram
+            gemini_breaker.record_failure()
+            metrics.inc("bot_gemini_errors_total", mode="stream")
+            raise
+        finally:
+            editor_task.cancel()
+            # Дочікуємося зупинки, щоб незавершене проміжне редагування не перезаписало фінальне
+            await asyncio.wait([editor_task])
+        gemini_breaker.record_success()
+        record_gemini_tokens(prompt, text, "stream")
+    except Exception:
+        # Прибираємо заглушку - повідомлення про помилку надішле обробник
+        try:
+            await placeholder.delete()
+        except Exception:
+            pass
+        raise
+    if text[:TELEGRAM_MESSAGE_LIMIT] != shown:
+        await wait_stream_edit_slot(chat_id)
+        await placeholder.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+    # Що не вмістилося в одне повідомлення - окремими відповідями
+    for i in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+        await message.reply_text(text[i:i + TELEGRAM_MESSAGE_LIMIT])
+    return text
+async def deliver_ai_reply(message, prompt, cache_key):
+    """Відповідає на message: з кешу, потоково або одним повідомленням; повертає текст відповіді
+    (None, якщо Gemini недоступний і надіслано заготовлену відповідь)"""
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            await message.reply_text(cached)
+            return cached
+    try:
+        if GEMINI_STREAMING:
+            reply_text = await stream_ai_reply(prompt, message)
+        else:
+            reply_text = await generate_ai_reply(prompt)
+            await message.reply_text(reply_text)
+    except CircuitOpenError:
+        # Gemini недоступний - миттєва заготовлена відповідь замість очікування тайм-ауту
+        await message.reply_text(GEMINI_UNAVAILABLE_REPLY)
+        return None
+    if cache_key:
+        response_cache.put(cache_key, reply_text)
+    return reply_text
+# === ЧЕРГА AI-ЗАПИТІВ ===
+# Вікно (в секундах), в якому кілька швидких повідомлень користувача зливаються в один запит (0 - вимкнено)
+AI_DEBOUNCE_SECONDS = float(os.getenv("AI_DEBOUNCE_SECONDS", "0"))
+# Скільки AI-запитів одночасно може очікувати відповіді в одному чаті
+AI_MAX_PENDING_PER_CHAT = int(os.getenv("AI_MAX_PENDING_PER_CHAT", "3"))
+AI_BUSY_MESSAGE = "⏳ Зачекайте, я ще відповідаю на попередні запитання в цьому чаті."
+def merge_ai_requests(batch):
+    """Зливає кілька запитів користувача в один; відповідь піде на останнє повідомлення"""
+    if len(batch) == 1:
+        return batch[0]
+    return {
+        "message": batch[-1]["message"],
+        "query": "\n".join(request["query"] for request in batch),
+        "reply_context": next((request["reply_context"] for request in batch if request["reply_context"]), ""),
+        "saved_text": "\n".join(request["saved_text"] for request in batch),
+    }
+class AIRequestQueue:
+    """Послідовні ходи для одного користувача, злиття швидких повідомлень і ліміт запитів на чат"""
+    def __init__(self):
+        # user_id -> [lock, кількість запитів, що його використовують]
+        self.user_locks = {}
+        # (chat_id, user_id) -> запити, зібрані у вікні злиття (зливаємо лише в межах одного чату)
+        self.pending = {}
+        self.chat_outstanding = {}
+    async def submit(self, chat_id, user_id, request, handler):
+        """Виконує handler(request) по черзі для користувача; False - запит відхилено через ліміт чату"""
+        pending_key = (chat_id, user_id)
+        if AI_DEBOUNCE_SECONDS > 0 and pending_key in self.pending:
+            # Запит у цьому чаті вже збирається - це повідомлення увійде в нього
+            self.pending[pending_key].append(request)
+            return True
+        if self.chat_outstanding.get(chat_id, 0) >= AI_MAX_PENDING_PER_CHAT:
+            return False
+        self.chat_outstanding[chat_id] = self.chat_outstanding.get(chat_id, 0) + 1
+        lock_entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        lock_entry[1] += 1
+        try:
+            if AI_DEBOUNCE_SECONDS > 0:
+                self.pending[pending_key] = [request]
+                try:
+                    await asyncio.sleep(AI_DEBOUNCE_SECONDS)
+                finally:
+                    batch = self.pending.pop(pending_key)
+                request = merge_ai_requests(batch)
+            async with lock_entry[0]:
+                await handler(request)
+            return True
+        finally:
+            lock_entry[1] -= 1
+            if not lock_entry[1]:
+                del self.user_locks[user_id]
+            self.chat_outstanding[chat_id] -= 1
+            if not self.chat_outstanding[chat_id]:
+                del self.chat_outstanding[chat_id]
+ai_request_queue = AIRequestQueue()
+async def run_ai_turn(context: ContextTypes.DEFAULT_TYPE, user, request):
+    """Один хід розмови: запит до Gemini (або кешу), відповідь користувачу, збереження історії"""
+    personality = context.bot_data.get("gemini_personality", "")
+    user_name = await get_user_name(user)
+    query_text = request["query"]
+    reply_context = request["reply_context"]
+    # Формуємо запит з персоналізацією, підсумком та історією в межах бюджету токенів
+    cache_key = response_cache_key(user.id, personality, query_text, reply_context)
+    prompt = build_ai_prompt(
+        user.id,
+        personality,
+        reply_context,
+        # Відповідь з кешу бачать усі користувачі - ім'я в кешований запит не додаємо
+        f"Користувач: {query_text}\nАсистент:" if cache_key else f"Користувач ({user_name}): {query_text}\nАсистент:"
+    )
+    # Отримуємо відповідь від Gemini (або з кешу) і одразу показуємо її користувачу
+    reply_text = await deliver_ai_reply(request["message"], prompt, cache_key)
+    if reply_text is None:
+        # Заготовлена відповідь при недоступному Gemini в історію не потрапляє
+        return
+    # Зберігаємо крок розмови
+    await save_conversation_step(
+        user_id=user.id,
+        user_message=request["saved_text"],
+        bot_response=reply_text,
+        user_name=user_name
+    )
+    schedule_history_summary(context, user.id)
+async def submit_ai_turn(context: ContextTypes.DEFAULT_TYPE, chat_id, user, message, query_text, reply_context="", saved_text=None):
+    """Ставить хід розмови в чергу користувача; якщо чат перевантажений - повідомляє про це"""
+    request = {
+        "message": message,
+        "query": query_text,
+        "reply_context": reply_context,
+        "saved_text": saved_text if saved_text is not None else query_text,
+    }
+    accepted = await ai_request_queue.submit(
+        chat_id,
+        user.id,
+        request,
+        lambda merged_request: run_ai_turn(context, user, merged_request)
+    )
+    if not accepted:
+        busy_msg = await message.reply_text(AI_BUSY_MESSAGE)
+        await schedule_message_deletion(context, chat_id, busy_msg.message_id, 10)
+    return accepted
+# Користувачі, для яких підсумок уже готується
+summaries_in_progress = set()
+async def summarize_history(user_id, folded_messages, previous_summary):
+    """Згортає найстаріші повідомлення разом з попереднім підсумком у новий підсумок"""
+    try:
+        prompt = (
+            "Стисло (до 5 речень) підсумуй розмову користувача з асистентом, зберігши факти про користувача "
+            "і незавершені теми.\n"
+        )
+        if previous_summary:
+            prompt += f"Попередній підсумок: {previous_summary}\n"
+        prompt += "Повідомлення:\n" + "\n".join(folded_messages)
+        summary = await generate_ai_reply(prompt)
+        conversation_store.fold(user_id, folded_messages, summary)
+    except Exception as e:
+        ai_log.warning("Не вдалося підсумувати розмову: %s", e, extra={"user_id": user_id})
+    finally:
+        summaries_in_progress.discard(user_id)
+def schedule_history_summary(context: ContextTypes.DEFAULT_TYPE, user_id):
+    """У фоні згортає повідомлення, що вже не вміщуються в бюджет або скоро випадуть з кільця"""
+    user_id = str(user_id)
+    if user_id in summaries_in_progress:
+        return
+    history = conversation_store.get_history(user_id)
+    prefix_tokens = personality_prefix_cache["tokens"]
+    over_budget = len(history) - fit_history(history, PROMPT_TOKEN_BUDGET // 2 - prefix_tokens)
+    # Згортаємо лише коли кільце заповнене (наступний крок витіснить найстаріші) або історія не вміщується в бюджет -
+    # і одразу половину кільця, щоб підсумок готувався раз на кілька кроків, а не щоразу
+    if over_budget <= 0 and len(history) < CONVERSATION_HISTORY_LIMIT:
+        return
+    fold_count = max(over_budget, len(history) // 2)
+    fold_count += fold_count % 2
+    if fold_count <= 0:
+        return
+    summaries_in_progress.add(user_id)
+    context.application.create_task(
+        summarize_history(user_id, history[:fold_count], conversation_store.get_summary(user_id))
+    )
 # === ФУНКЦІЇ ДЛЯ РОБОТИ З ДАНИМИ БОТА ===
 def load_persistent_data():
-    """Завантажує дані бота з файлу"""
-    return load_json(DATA_FILE)
-def save_persistent_data(data):
-    """Зберігає дані бота у файл"""
-    save_json(DATA_FILE, data)
+    """Завантажує дані бота з обраного сховища"""
+    data = bot_data_store.load()
+    for key in STALE_BOT_DATA_KEYS:
+        if key in data:
+            del data[key]
+            save_persistent_data(data, "settings", (key,))
+    return data
+def save_persistent_data(data, table=None, *keys):
+    """Позначає дані бота зміненими (table і ключі рядків - див. SQLITE_TABLES); запис на диск виконує flush_bot_data_job"""
+    bot_data_store.mark_dirty(data, table, *keys)
+async def flush_bot_data_job(context: ContextTypes.DEFAULT_TYPE):
+    """Періодично скидає змінені дані бота на диск"""
+    await bot_data_store.flush()
+# === ЕНДПОІНТ /metrics ===
+BREAKER_STATES = ("closed", "half_open", "open")
+metrics_server = None
+def register_runtime_metrics(application):
+    """Значення, що знімаються в момент запиту: черги, кеш відповідей, запобіжник Gemini"""
+    metrics.register("bot_job_queue_jobs", "gauge", "Задачі в JobQueue", lambda: len(application.job_queue.jobs()))
+    metrics.register("bot_update_queue_size", "gauge", "Оновлення, що чекають обробки", lambda: application.update_queue.qsize())
+    metrics.register("bot_pending_deletions", "gauge", "Повідомлення в черзі на видалення", lambda: len(application.bot_data.get("pending_deletions", [])))
+    metrics.register("bot_scheduled_unmutes", "gauge", "Записи в індексі автоматичних розмутів", lambda: len(unmute_scheduler.heap))
+    metrics.register("bot_ai_requests_outstanding", "gauge", "AI-запити в роботі або в черзі", lambda: sum(ai_request_queue.chat_outstanding.values()))
+    metrics.register("bot_response_cache_hits_total", "counter", "Відповіді Gemini, видані з кешу", lambda: response_cache.stats()["hits"])
+    metrics.register("bot_response_cache_misses_total", "counter", "Промахи кешу відповідей", lambda: response_cache.stats()["misses"])
+    metrics.register("bot_response_cache_entries", "gauge", "Записи в кеші відповідей", lambda: response_cache.stats()["size"])
+    metrics.register("bot_gemini_breaker_state", "gauge", "Стан запобіжника Gemini (1 - поточний)", lambda: [({"state": state}, int(gemini_breaker.state == state)) for state in BREAKER_STATES])
+    metrics.register("bot_gemini_breaker_rejected_total", "counter", "Запити, відхилені запобіжником", lambda: gemini_breaker.stats()["rejected"])
+    metrics.register("bot_gemini_breaker_opened_total", "counter", "Скільки разів запобіжник відкривався", lambda: gemini_breaker.stats()["times_opened"])
+    metrics.register("bot_profiling_enabled", "gauge", "Чи увімкнене профілювання оновлень", lambda: int(profiler.enabled))
+    metrics.register("bot_profiler_slow_updates_total", "counter", "Повільні запуски обробників, записані профайлером", lambda: profiler.slow_updates)
+    metrics.register("bot_gemini_breaker_window_failures", "gauge", "Невдалі виклики у вікні запобіжника", lambda: gemini_breaker.stats()["window_failures"])
+async def handle_metrics_request(reader, writer):
+    """Відповідає на GET /metrics; інші шляхи - 404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запиту не потрібні - дочитуємо до порожнього рядка
+        while await asyncio.wait_for(reader.readline(), timeout=5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+async def start_metrics_server(application):
+    """Реєструє метрики стану і запускає ендпоінт /metrics (якщо METRICS_PORT не 0)"""
+    global metrics_server
+    register_runtime_metrics(application)
+    if not METRICS_PORT:
+        return
+    try:
+        metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+        log.info("Метрики доступні на http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    except OSError as e:
+        log.error("Не вдалося запустити ендпоінт метрик: %s", e)
 async def post_init(application):
     """Ініціалізація бота при старті"""
     persistent_data = load_persistent_data()
     application.bot_data.update(persistent_data)
-    print("Дані завантажено з файлу")
-def save_bot_data(context: ContextTypes.DEFAULT_TYPE):
-    """Зберігає поточні дані бота"""
-    save_persistent_data(context.bot_data)
+    storage_log.info("Дані завантажено з файлу")
+    conversation_store.load()
+    username_index.rebuild(application.bot_data.get("profiles", {}))
+    if reputation_store.attach(application.bot_data):
+        # Старий формат ключів "chatid_userid" сконвертовано - зберігаємо новий
+        save_persistent_data(application.bot_data)
+    # Відновлюємо заплановані розмути; прострочені знімуться першою ж перевіркою
+    unmute_scheduler.rebuild(application.bot_data.get("muted_users", {}))
+    application.job_queue.run_repeating(
+        auto_unmute_callback,
+        interval=UNMUTE_CHECK_INTERVAL,
+        first=0,
+        name="auto_unmute"
+    )
+    application.job_queue.run_repeating(
+        compact_conversations_job,
+        interval=CONVERSATIONS_COMPACT_INTERVAL,
+        first=CONVERSATIONS_COMPACT_INTERVAL,
+        name="compact_conversations"
+    )
+    # Черга видалень після JSON - список списків, відновлюємо властивість купи
+    heapq.heapify(application.bot_data.setdefault("pending_deletions", []))
+    application.job_queue.run_repeating(
+        delete_messages_job,
+        interval=DELETE_CHECK_INTERVAL,
+        first=0,
+        name="delete_messages"
+    )
+    application.job_queue.run_repeating(
+        flush_bot_data_job,
+        interval=SAVE_INTERVAL,
+        first=SAVE_INTERVAL,
+        name="flush_bot_data"
+    )
+    await start_metrics_server(application)
+async def post_shutdown(application):
+    """Зберігає незаписані зміни при зупинці бота"""
+    if metrics_server is not None:
+        metrics_server.close()
+    await bot_data_store.flush()
+    bot_data_store.close()
+    await conversation_store.compact()
+    storage_log.info("Дані збережено перед зупинкою")
+def save_bot_data(context: ContextTypes.DEFAULT_TYPE, table=None, *keys):
+    """Зберігає поточні дані бота (лише вказані рядки, якщо передано table і ключі)"""
+    save_persistent_data(context.bot_data, table, *keys)
+# === ОБМЕЖЕННЯ ВИХІДНИХ ЗАПИТІВ ДО TELEGRAM ===
+# Ліміти Telegram: ~30 запитів/с загалом, 1 повідомлення/с в приват, 20 повідомлень/хв у групу
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "30"))
+RATE_LIMIT_PRIVATE_PER_SECOND = float(os.getenv("RATE_LIMIT_PRIVATE_PER_SECOND", "1"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+# Скільки разів повторюємо запит після 429 (RetryAfter)
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+# Скільки секунд некритичне повідомлення може чекати ліміту, перш ніж його буде пропущено
+RATE_LIMIT_COSMETIC_MAX_WAIT = float(os.getenv("RATE_LIMIT_COSMETIC_MAX_WAIT", "20"))
+# Пріоритети (менше - важливіше); можна передати явно через rate_limit_args=...
+PRIORITY_MODERATION = 0
+PRIORITY_NORMAL = 1
+PRIORITY_COSMETIC = 2
+ENDPOINT_PRIORITIES = {
+    "restrictChatMember": PRIORITY_MODERATION,
+    "banChatMember": PRIORITY_MODERATION,
+    "unbanChatMember": PRIORITY_MODERATION,
+    "deleteMessage": PRIORITY_COSMETIC,
+    "deleteMessages": PRIORITY_COSMETIC,
+}
+# Пріоритет запитів поточного обробника (див. with_priority); діє і на задачі, створені з нього
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_NORMAL)
+class RequestDropped(TelegramError):
+    """Некритичне повідомлення не дочекалося ліміту Telegram і не надіслане"""
+def with_priority(callback, priority):
+    """Обробник, усі вихідні запити якого мають вказаний пріоритет"""
+    @functools.wraps(callback)
+    async def prioritized(update, context):
+        token = request_priority.set(priority)
+        try:
+            return await callback(update, context)
+        except RequestDropped as e:
+            # Відповідь застаріла, поки чекала ліміту групи - це не помилка обробника
+            api_log.info("Відповідь пропущено: %s", e)
+        finally:
+            request_priority.reset(token)
+    return prioritized
+class TokenBucket:
+    """Відро токенів: черга очікування впорядкована за пріоритетом"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = []
+        self._counter = 0
+        self._task = None
+        # До цього моменту токени не видаються (пауза після 429)
+        self.paused_until = 0.0
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    def is_idle(self):
+        self._refill()
+        return not self.waiters and self.tokens >= self.capacity and time.monotonic() >= self.paused_until
+    def pause(self, seconds):
+        """Зупиняє видачу токенів на seconds секунд (Telegram відповів RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    async def wait_unpaused(self):
+        """Чекає кінця паузи, не витрачаючи токен"""
+        while time.monotonic() < self.paused_until:
+            await asyncio.sleep(self.paused_until - time.monotonic())
+    async def acquire(self, priority, max_wait=None):
+        """Чекає токен; False - не дочекався за max_wait секунд"""
+        self._refill()
+        if not self.waiters and self.tokens >= 1 and time.monotonic() >= self.paused_until:
+            self.tokens -= 1
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._counter += 1
+        heapq.heappush(self.waiters, (priority, self._counter, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+        if max_wait is None:
+            await future
+            return True
+        try:
+            # Скасований future _drain просто пропустить, не витрачаючи токен
+            await asyncio.wait_for(future, timeout=max(max_wait, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+    async def _drain(self):
+        """Видає токени очікувачам у порядку пріоритету"""
+        while self.waiters:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done():
+                    self.tokens -= 1
+                    future.set_result(None)
+                continue
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+class OutboundRateLimiter(BaseRateLimiter):
+    """Спільний планувальник вихідних запитів: глобальне і по-чатове обмеження, пріоритети, RetryAfter"""
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_PER_SECOND)
+        self.chat_buckets = {}
+    async def initialize(self):
+        pass
+    async def shutdown(self):
+        pass
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                # Прибираємо відра чатів, які давно нічого не надсилали
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+            is_group = str(chat_id).startswith('-')
+            if is_group:
+                bucket = TokenBucket(RATE_LIMIT_GROUP_PER_MINUTE / 60, RATE_LIMIT_GROUP_PER_MINUTE / 4)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_PRIVATE_PER_SECOND, RATE_LIMIT_PRIVATE_PER_SECOND * 3)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITIES.get(endpoint, request_priority.get())
+        chat_id = data.get("chat_id")
+        # Ліміт чату (20/хв у групі) стосується лише надсилання повідомлень - не мутів, видалень чи редагувань
+        per_chat = chat_id is not None and endpoint.startswith("send")
+        # Некритичні повідомлення не чекають безкінечно - застарілу відповідь краще пропустити
+        max_wait = RATE_LIMIT_COSMETIC_MAX_WAIT if priority >= PRIORITY_COSMETIC and endpoint.startswith("send") else None
+        attempt = 0
+        while True:
+            with profile_span("rate_limit", endpoint):
+                deadline = time.monotonic() + max_wait if max_wait is not None else None
+                acquired = True
+                if per_chat:
+                    acquired = await self._chat_bucket(chat_id).acquire(priority, max_wait)
+                elif chat_id is not None and chat_id in self.chat_buckets:
+                    # Мути, видалення й редагування не витрачають ліміт чату, але чекають його паузу після 429
+                    await self.chat_buckets[chat_id].wait_unpaused()
+                if acquired:
+                    acquired = await self.global_bucket.acquire(priority, None if deadline is None else deadline - time.monotonic())
+                if not acquired:
+                    metrics.inc("bot_telegram_api_errors_total", method=endpoint, error="RequestDropped")
+                    raise RequestDropped(f"{endpoint} у чат {chat_id} чекав ліміту довше {max_wait:g} с")
+            started = time.monotonic()
+            try:
+                with profile_span("api", endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.inc("bot_telegram_api_errors_total", method=endpoint, error="RetryAfter")
+                attempt += 1
+                if attempt > RATE_LIMIT_MAX_RETRIES:
+                    raise
+                # Флуд в одній групі не зупиняє модерацію в інших - пауза лише для цього чату
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self.global_bucket.pause(e.retry_after)
+                api_log.warning("Telegram обмежив запити (%s), повтор через %s с", endpoint, e.retry_after, extra={"chat_id": chat_id})
+            except Exception as e:
+                metrics.inc("bot_telegram_api_errors_total", method=endpoint, error=type(e).__name__)
+                raise
+            finally:
+                metrics.observe("bot_telegram_api_latency_seconds", time.monotonic() - started, method=endpoint)
 # === ФУНКЦІЇ ДЛЯ ПЕРЕВІРКИ ПРАВ АДМІНІСТРАТОРА ===
+# Скільки секунд вважаємо список адмінів групи актуальним
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+class AdminCache:
+    """Кеш адмінів груп: chat_id -> {user_id: ChatMember} з часом життя"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.chats = {}
+    def get_admins(self, chat_id):
+        """Повертає словник адмінів групи або None, якщо кеш застарів"""
+        entry = self.chats.get(int(chat_id))
+        if entry is None:
+            return None
+        expires_at, admins = entry
+        if time.monotonic() >= expires_at:
+            del self.chats[int(chat_id)]
+            return None
+        return admins
+    def get(self, chat_id, user_id):
+        """Повертає True/False з кешу або None, якщо даних немає"""
+        admins = self.get_admins(chat_id)
+        if admins is None:
+            return None
+        return int(user_id) in admins
+    def set_admins(self, chat_id, members):
+        self.chats[int(chat_id)] = (time.monotonic() + self.ttl, {member.user.id: member for member in members})
+    def invalidate(self, chat_id):
+        self.chats.pop(int(chat_id), None)
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+async def get_chat_admins(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Повертає адмінів групи з кешу, за потреби завантажує їх одним запитом"""
+    admins = admin_cache.get_admins(chat_id)
+    if admins is None:
+        members = await context.bot.get_chat_administrators(chat_id)
+        admin_cache.set_admins(chat_id, members)
+        admins = admin_cache.get_admins(chat_id)
+    return admins
 async def is_user_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
     """Перевіряє, чи є користувач адміністратором"""
     try:
-        user = await context.bot.get_chat_member(chat_id, user_id)
-        return user.status in ['administrator', 'creator']
+        admins = await get_chat_admins(context, chat_id)
+        return user_id in admins
     except:
         return False
+# Скільки перевірок прав по групах виконуємо одночасно
+ADMIN_CHECK_CONCURRENCY = int(os.getenv("ADMIN_CHECK_CONCURRENCY", "10"))
+async def get_admin_groups(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Паралельно перевіряє всі відомі групи і повертає [(group_id, title)], де користувач адмін"""
+    groups = context.bot_data.get("groups", {})
+    semaphore = asyncio.Semaphore(ADMIN_CHECK_CONCURRENCY)
+    async def check(group_id):
+        async with semaphore:
+            return await is_user_admin(context, group_id, user_id)
+    group_items = [(int(group_id) if isinstance(group_id, str) else group_id, group_data) for group_id, group_data in groups.items()]
+    results = await asyncio.gather(*(check(group_id) for group_id, _ in group_items))
+    return [
+        (group_id, group_data.get("title", f"Група {group_id}"))
+        for (group_id, group_data), is_admin in zip(group_items, results)
+        if is_admin
+    ]
+async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Скидає кеш адмінів групи при зміні статусу учасника"""
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
+    old_status = member_update.old_chat_member.status
+    new_status = member_update.new_chat_member.status
+    # Звичайні вступи й виходи список адмінів не змінюють
+    if {'administrator', 'creator'} & {old_status, new_status}:
+        admin_cache.invalidate(member_update.chat.id)
 # === ФУНКЦІЇ ДЛЯ РОБОТИ З ЧАСОМ ===
 def parse_duration(duration_str: str) -> timedelta:
     """Перетворює строку типу 5h у timedelta"""
@@ -111,12 +1641,34 @@ def parse_duration(duration_str: str) -> timedelta:
     else:
         raise ValueError("Неправильний формат часу.")
 # === ФУНКЦІЇ ДЛЯ АВТОМАТИЧНОГО РОЗМУТУ ===
-async def auto_unmute_callback(context: ContextTypes.DEFAULT_TYPE):
-    """Функція, викликається по закінченню часу мута."""
-    job = context.job
-    chat_id = job.data['chat_id']
-    user_id = job.data['user_id']
-    username = job.data['username']
+# Як часто (в секундах) перевіряємо, чи не минув час мутів
+UNMUTE_CHECK_INTERVAL = float(os.getenv("UNMUTE_CHECK_INTERVAL", "5"))
+class UnmuteScheduler:
+    """Впорядкований за часом індекс мутів (купа), відновлюється з muted_users при старті"""
+    def __init__(self):
+        self.heap = []
+    def schedule(self, chat_id, user_id, until_time: datetime):
+        heapq.heappush(self.heap, (until_time.timestamp(), int(chat_id), int(user_id)))
+    def rebuild(self, muted_users):
+        """Перебудовує індекс з muted_users (включно з уже простроченими мутами)"""
+        self.heap = []
+        for chat_id, users in muted_users.items():
+            for user_id, data in users.items():
+                try:
+                    until_time = datetime.fromisoformat(data["until"])
+                except Exception:
+                    continue
+                self.heap.append((until_time.timestamp(), int(chat_id), int(user_id)))
+        heapq.heapify(self.heap)
+    def pop_due(self, now_ts):
+        """Повертає всі записи, час яких уже минув"""
+        due = []
+        while self.heap and self.heap[0][0] <= now_ts:
+            due.append(heapq.heappop(self.heap))
+        return due
+unmute_scheduler = UnmuteScheduler()
+async def auto_unmute_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, username: str):
+    """Знімає мут з користувача, час якого минув."""
     bot = context.bot
     try:
         # Розмут користувача
@@ -138,30 +1690,196 @@ async def auto_unmute_callback(context: ContextTypes.DEFAULT_TYPE):
         muted_data = context.bot_data.get("muted_users", {}).get(str(chat_id), {})
         if str(user_id) in muted_data:
             del muted_data[str(user_id)]
-            save_persistent_data(context.bot_data)
+            save_persistent_data(context.bot_data, "muted_users", (chat_id, user_id))
         # Відправляємо повідомлення в чат
         unmute_msg = f"⏰ Таймер мута @{username} завершено. Кляп знято автоматично."
-        await bot.send_message(chat_id=chat_id, text=unmute_msg)
-        print(f"✅ Автоматично розмучено користувача {username} (ID: {user_id}) в чаті {chat_id}")
+        await bot.send_message(chat_id=chat_id, text=unmute_msg, rate_limit_args=PRIORITY_MODERATION)
+        mute_log.info("Автоматично розмучено користувача %s", username, extra={"chat_id": chat_id, "user_id": user_id})
     except Exception as e:
-        print(f"⚠️ Помилка при автоматичному розмуті {username} (ID: {user_id}) в чаті {chat_id}: {e}")
+        mute_log.error("Помилка при автоматичному розмуті %s: %s", username, e, extra={"chat_id": chat_id, "user_id": user_id})
+async def auto_unmute_callback(context: ContextTypes.DEFAULT_TYPE):
+    """Функція, викликається періодично і знімає всі мути, час яких минув."""
+    now_ts = datetime.now(timezone.utc).timestamp()
+    muted_users = context.bot_data.get("muted_users", {})
+    releases = []
+    for until_ts, chat_id, user_id in unmute_scheduler.pop_due(now_ts):
+        data = muted_users.get(str(chat_id), {}).get(str(user_id))
+        if not data:
+            # Вже розмучено вручну
+            continue
+        try:
+            current_until_ts = datetime.fromisoformat(data["until"]).timestamp()
+        except Exception:
+            current_until_ts = until_ts
+        if current_until_ts > now_ts:
+            # Мут продовжено - для нового часу в індексі є окремий запис
+            continue
+        releases.append(auto_unmute_user(context, chat_id, user_id, data.get("username", user_id)))
+    if releases:
+        await asyncio.gather(*releases)
 # === ВСПОМОГАТЕЛЬНІ ФУНКЦІЇ ===
-async def safe_delete_message(chat_id: int, message_id: int, bot):
-    """Безпечне видалення повідомлення з обробкою помилок."""
-    try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        print(f"🗑️ Повідомлення {message_id} видалено з чату {chat_id}")
-    except Exception as e:
-        print(f"⚠️ Не вдалося видалити повідомлення {message_id} з чату {chat_id}: {e}")
+# Як часто (в секундах) видаляємо повідомлення, час яких настав
+DELETE_CHECK_INTERVAL = float(os.getenv("DELETE_CHECK_INTERVAL", "1"))
+# Telegram дозволяє видалити не більше 100 повідомлень одним запитом
+DELETE_BATCH_SIZE = 100
+async def safe_delete_messages(chat_id: int, message_ids: list, bot):
+    """Безпечне пакетне видалення повідомлень з обробкою помилок."""
+    for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[i:i + DELETE_BATCH_SIZE]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            deletion_log.info("Видалено повідомлень: %d", len(batch), extra={"chat_id": chat_id})
+        except Exception as e:
+            deletion_log.warning("Не вдалося видалити повідомлення %s: %s", batch, e, extra={"chat_id": chat_id})
 async def schedule_message_deletion(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: int):
     """Планує видалення повідомлення через певний час."""
-    context.job_queue.run_once(
-        callback=lambda ctx: asyncio.create_task(safe_delete_message(chat_id, message_id, ctx.bot)),
-        when=delay,
-        data={'chat_id': chat_id, 'message_id': message_id}
-    )
+    # Черга - купа [час видалення, chat_id, message_id] у bot_data, тож переживає перезапуск
+    pending = context.bot_data.setdefault("pending_deletions", [])
+    heapq.heappush(pending, [time.time() + delay, chat_id, message_id])
+    save_bot_data(context, "pending_deletions", (chat_id, message_id))
+async def reap_deletions(due_by_chat, bot):
+    """Видаляє повідомлення кількох чатів паралельно"""
+    await asyncio.gather(*(
+        safe_delete_messages(chat_id, message_ids, bot)
+        for chat_id, message_ids in due_by_chat.items()
+    ))
+# Фонова задача, що зараз видаляє повідомлення (не більше однієї одночасно)
+deletion_reaper = None
+async def delete_messages_job(context: ContextTypes.DEFAULT_TYPE):
+    """Раз на тік передає фоновій задачі всі повідомлення, час яких настав, згрупувавши їх по чатах"""
+    global deletion_reaper
+    # Видалення чекають ліміту запитів - тік не блокується, а наступна партія чекає завершення попередньої
+    if deletion_reaper is not None and not deletion_reaper.done():
+        return
+    pending = context.bot_data.get("pending_deletions")
+    if not pending or pending[0][0] > time.time():
+        return
+    now = time.time()
+    due_by_chat = {}
+    while pending and pending[0][0] <= now:
+        _, chat_id, message_id = heapq.heappop(pending)
+        due_by_chat.setdefault(chat_id, []).append(message_id)
+    save_bot_data(context, "pending_deletions", *((chat_id, message_id) for chat_id, message_ids in due_by_chat.items() for message_id in message_ids))
+    deletion_reaper = context.application.create_task(reap_deletions(due_by_chat, context.bot))
+# === СХОВИЩЕ РЕПУТАЦІЇ (ЛИНЕЙКА) ===
+def convert_legacy_reputations(reputations):
+    """Перетворює старі ключі "chatid_userid" на вкладені {chat_id: {user_id: довжина}}"""
+    legacy_keys = [key for key, value in reputations.items() if not isinstance(value, dict)]
+    for key in legacy_keys:
+        value = reputations.pop(key)
+        chat_id, _, user_id = key.rpartition('_')
+        if chat_id and isinstance(value, (int, float)):
+            reputations.setdefault(chat_id, {})[user_id] = value
+    return bool(legacy_keys)
+class ReputationStore:
+    """Линейки по чатах: bot_data["reputations"] = {chat_id: {user_id: довжина}} + відсортований рейтинг"""
+    def __init__(self):
+        self.scores = {}
+        # chat_id -> відсортований список (-довжина, user_id)
+        self.rankings = {}
+    def attach(self, bot_data):
+        """Підключає сховище до bot_data, конвертуючи старі ключі "chatid_userid" """
+        reputations = bot_data.setdefault("reputations", {})
+        converted = convert_legacy_reputations(reputations)
+        self.scores = reputations
+        self.rankings = {
+            chat_id: sorted((-length, user_id) for user_id, length in chat_scores.items() if isinstance(length, (int, float)))
+            for chat_id, chat_scores in reputations.items()
+        }
+        return converted
+    def get(self, chat_id, user_id):
+        return self.scores.get(str(chat_id), {}).get(str(user_id), 0)
+    def change(self, chat_id, user_id, delta):
+        """Змінює линейку на delta (не нижче 0) і повертає нове значення"""
+        chat_id, user_id = str(chat_id), str(user_id)
+        chat_scores = self.scores.setdefault(chat_id, {})
+        ranking = self.rankings.setdefault(chat_id, [])
+        current_length = chat_scores.get(user_id)
+        if current_length is not None:
+            index = bisect.bisect_left(ranking, (-current_length, user_id))
+            if index < len(ranking) and ranking[index] == (-current_length, user_id):
+                del ranking[index]
+        new_length = max((current_length or 0) + delta, 0)
+        chat_scores[user_id] = new_length
+        bisect.insort(ranking, (-new_length, user_id))
+        return new_length
+    def top(self, chat_id, count):
+        """Повертає [(user_id, довжина)] для перших count місць"""
+        return [(user_id, -neg_length) for neg_length, user_id in self.rankings.get(str(chat_id), [])[:count]]
+    def rank(self, chat_id, user_id):
+        """Повертає (місце, кількість учасників) або None, якщо линейки ще немає"""
+        length = self.scores.get(str(chat_id), {}).get(str(user_id))
+        if length is None:
+            return None
+        ranking = self.rankings.get(str(chat_id), [])
+        # Однакові линейки ділять одне місце
+        return bisect.bisect_left(ranking, (-length, "")) + 1, len(ranking)
+reputation_store = ReputationStore()
+# === КЕШ ІМЕН КОРИСТУВАЧІВ ===
+# Скільки секунд довіряємо запам'ятованому імені без повторного запиту до Telegram
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "86400"))
+# Скільки користувачів тримаємо в кеші; найдавніше бачені витісняються першими
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+class UserIdentityCache:
+    """LRU-кеш user_id -> (username, first_name), наповнюється з кожного вхідного оновлення"""
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.users = OrderedDict()
+    def remember(self, user):
+        if user:
+            self.users[user.id] = (time.monotonic(), user.username, user.first_name)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+    def get(self, user_id):
+        """Повертає (username, first_name) або None, якщо запису немає чи він застарів"""
+        user_id = int(user_id)
+        entry = self.users.get(user_id)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            if entry is not None:
+                del self.users[user_id]
+            return None
+        self.users.move_to_end(user_id)
+        return entry[1], entry[2]
+user_cache = UserIdentityCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+async def get_user_identity(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
+    """Повертає (username, first_name) з кешу, а якщо немає - запитує get_chat_member"""
+    cached = user_cache.get(user_id)
+    if cached:
+        return cached
+    member = await context.bot.get_chat_member(chat_id, user_id)
+    user_cache.remember(member.user)
+    return member.user.username, member.user.first_name
+# === ІНДЕКС АНКЕТ ЗА USERNAME ===
+class UsernameIndex:
+    """Індекс username (без урахування регістру) -> user_id для анкет з bot_data["profiles"]"""
+    def __init__(self):
+        self.by_username = {}
+    def rebuild(self, profiles):
+        self.by_username = {
+            profile_data["username"].lower(): user_id
+            for user_id, profile_data in profiles.items()
+            if profile_data.get("username")
+        }
+    def update(self, user_id, old_username, new_username):
+        user_id = str(user_id)
+        if old_username and self.by_username.get(old_username.lower()) == user_id:
+            del self.by_username[old_username.lower()]
+        if new_username:
+            self.by_username[new_username.lower()] = user_id
+    def lookup(self, username):
+        return self.by_username.get(username.lower())
+username_index = UsernameIndex()
 # === КОМАНДИ БОТА ===
 # Команда /start
+def main_menu_markup():
+    """Головне меню адміна (кнопка профілювання показує поточний стан)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Мути 🔇", callback_data="show_groups")],
+        [InlineKeyboardButton("Gemini Персона 🤖", callback_data="gemini_personality")],
+        [InlineKeyboardButton(f"Профілювання: {'увімк' if profiler.enabled else 'вимк'} ⏱", callback_data="toggle_profiling")]
+    ])
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     if update.effective_chat.type != "private":
@@ -170,23 +1888,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # Перевірка чи є користувач адміном хоча б в одній групі
     user_id = update.effective_user.id
-    groups = context.bot_data.get("groups", {})
-    is_admin_anywhere = False
-    for group_id in groups:
-        if await is_user_admin(context, int(group_id) if isinstance(group_id, str) else group_id, user_id):
-            is_admin_anywhere = True
-            break
+    # Користувач знову пише боту - отже, сповіщення йому можна надсилати
+    blocked_admins = context.bot_data.get("blocked_admins", [])
+    if user_id in blocked_admins:
+        blocked_admins.remove(user_id)
+        save_bot_data(context, "settings", ("blocked_admins",))
+    is_admin_anywhere = bool(await get_admin_groups(context, user_id))
     if not is_admin_anywhere:
         msg = await update.message.reply_text("Я впихну кляп тобі, якщо продовжиш тикати.")
         await schedule_message_deletion(context, update.effective_chat.id, msg.message_id, 10)
         await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
         return
-    keyboard = [
-        [InlineKeyboardButton("Мути 🔇", callback_data="show_groups")],
-        [InlineKeyboardButton("Gemini Персона 🤖", callback_data="gemini_personality")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    msg = await update.message.reply_text("Привіт! Я бот для управління мутами.", reply_markup=reply_markup)
+    msg = await update.message.reply_text("Привіт! Я бот для управління мутами.", reply_markup=main_menu_markup())
     await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
     # msg (повідомлення бота) не видаляється
 # Команда /date - створення анкети
@@ -203,6 +1916,8 @@ async def date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     profile_text = " ".join(context.args)
     # Зберігаємо анкету
     profiles = context.bot_data.setdefault("profiles", {})
+    old_profile = profiles.get(str(user.id), {})
+    username_index.update(user.id, old_profile.get("username"), user.username)
     profiles[str(user.id)] = {
         "username": user.username,
         "first_name": user.first_name,
@@ -210,7 +1925,7 @@ async def date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "created_at": datetime.now().isoformat()
     }
     # Зберігаємо на диск
-    save_bot_data(context)
+    save_bot_data(context, "profiles", (user.id,))
     # msg = await update.message.reply_text(f"@{user.username or user.first_name} Радий знайомству! Інформацію зберіг. Отримати інформацію інших користувачів через /who @username або дай відповідь на повідомлення цієї людини.")
     # await schedule_message_deletion(context, chat.id, msg.message_id, 10)
     # await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
@@ -230,14 +1945,14 @@ async def who(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Якщо вказано @username
     elif context.args:
         username = context.args[0].lstrip('@')
-        # Шукаємо користувача в profiles
+        # Шукаємо користувача в індексі анкет
         profiles = context.bot_data.get("profiles", {})
-        for user_id, profile_data in profiles.items():
-            if profile_data.get("username") == username:
-                # Створюємо фейковий об'єкт користувача
-                from telegram import User
-                target_user = User(id=int(user_id), first_name=profile_data.get("first_name", ""), username=username, is_bot=False)
-                break
+        user_id = username_index.lookup(username)
+        profile_data = profiles.get(user_id) if user_id else None
+        if profile_data:
+            # Створюємо фейковий об'єкт користувача
+            from telegram import User
+            target_user = User(id=int(user_id), first_name=profile_data.get("first_name", ""), username=profile_data.get("username") or username, is_bot=False)
         else:
             msg = await update.message.reply_text("Користувача не знайдено або у нього немає анкети.")
             await schedule_message_deletion(context, chat.id, msg.message_id, 10)
@@ -282,12 +1997,7 @@ async def muty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # В приватному чаті - показуємо групи
     if chat.type == "private":
         # Перевірка чи є користувач адміном хоча б в одній групі
-        groups = context.bot_data.get("groups", {})
-        user_groups = []
-        for group_id_str, group_data in groups.items():
-            group_id = int(group_id_str) if isinstance(group_id_str, str) else group_id_str
-            if await is_user_admin(context, group_id, user_id):
-                user_groups.append((group_id, group_data["title"]))
+        user_groups = await get_admin_groups(context, user_id)
         if not user_groups:
             msg = await update.message.reply_text("Я впихну кляп тобі, якщо продовжиш тикати.")
             await schedule_message_deletion(context, chat.id, msg.message_id, 10)
@@ -318,7 +2028,7 @@ async def muty(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if str(chat.id) not in groups:
             groups[str(chat.id)] = {"title": chat.title or f"Група {chat.id}"}
             # Зберігаємо на диск
-            save_bot_data(context)
+            save_bot_data(context, "groups", (chat.id,))
         muted_users = []
         try:
             muted_list = context.bot_data.get("muted_users", {}).get(str(chat.id), {})
@@ -363,24 +2073,14 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     duration_str = ""
     # Спроба знайти користувача через відповідь
     if update.message.reply_to_message:
-        try:
-            user_to_mute = await context.bot.get_chat_member(chat.id, update.message.reply_to_message.from_user.id)
-            if user_to_mute is None:
-                msg = await update.message.reply_text("Користувача не знайдено.")
-                await schedule_message_deletion(context, chat.id, msg.message_id, 10)
-                await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
-                return
-            args = context.args
-            if args:
-                duration_str = args[0]
-                reason = " ".join(args[1:]) if len(args) > 1 else ""
-            else:
-                msg = await update.message.reply_text("Вкажіть тривалість муту (наприклад: 5h).")
-                await schedule_message_deletion(context, chat.id, msg.message_id, 10)
-                await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
-                return
-        except Exception as e:
-            msg = await update.message.reply_text(f"Помилка: {e}")
+        # Автор повідомлення вже відомий - окремий get_chat_member не потрібен
+        user_to_mute = ChatMember(user=update.message.reply_to_message.from_user, status=ChatMember.MEMBER)
+        args = context.args
+        if args:
+            duration_str = args[0]
+            reason = " ".join(args[1:]) if len(args) > 1 else ""
+        else:
+            msg = await update.message.reply_text("Вкажіть тривалість муту (наприклад: 5h).")
             await schedule_message_deletion(context, chat.id, msg.message_id, 10)
             await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
             return
@@ -463,36 +2163,22 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "until": until_time.isoformat()
         }
         # Зберігаємо на диск
-        save_bot_data(context)
+        save_bot_data(context, "muted_users", (chat.id, user_to_mute.user.id))
         # Додаємо групу до списку, якщо її там немає
         groups = context.bot_data.setdefault("groups", {})
         if str(chat.id) not in groups:
             groups[str(chat.id)] = {"title": chat.title or f"Група {chat.id}"}
             # Зберігаємо на диск
-            save_bot_data(context)
+            save_bot_data(context, "groups", (chat.id,))
         # --- Планування автоматичного розмуту ---
-        try:
-            job_data = {
-                'chat_id': chat.id,
-                'user_id': user_to_mute.user.id,
-                'username': user_to_mute.user.username or user_to_mute.user.first_name
-            }
-            context.job_queue.run_once(
-                callback=auto_unmute_callback,
-                when=until_time,
-                data=job_data,
-                name=f"unmute_{chat.id}_{user_to_mute.user.id}"
-            )
-            print(f"⏰ Заплановано автоматичний розмут для {job_data['username']} в {until_time}")
-        except Exception as e:
-            print(f"⚠️ Помилка при плануванні авто-розмуту для {user_to_mute.user.username or user_to_mute.user.first_name}: {e}")
+        # Час мута вже збережено в muted_users, тож після перезапуску індекс відновиться
+        unmute_scheduler.schedule(chat.id, user_to_mute.user.id, until_time)
+        mute_log.info("Заплановано автоматичний розмут для %s в %s", user_to_mute.user.username or user_to_mute.user.first_name, until_time)
         gif_url = "https://media1.giphy.com/media/v1.Y2lkPTc5MGI3NjExYzNiaXo0YTZod2J0NmUzOXJ5Ymtid3ZpMGcxMjUxMTZxY2dybjJmOSZlcD12MV9pbnRlcm5hbF9naWZfYnlfaWQmY3Q9Zw/snCdBOKXIgIf2perjF/giphy.gif"
         mute_message = f"@{user_to_mute.user.username or user_to_mute.user.first_name}, кляп встановлено @{admin_user.username or admin_user.first_name}! Не балуй, хлопчику!"
         msg = await update.message.reply_animation(animation=gif_url, caption=mute_message)
-        # Сповіщаємо адмінів в боті
+        # Сповіщаємо адмінів в боті (у фоні, команда не чекає на розсилку)
         try:
-            # Отримуємо всіх адмінів
-            admins = await context.bot.get_chat_administrators(chat.id)
             # Формуємо повідомлення
             mute_msg = f"🔇 @{admin_user.username or admin_user.first_name} замутив @{user_to_mute.user.username or user_to_mute.user.first_name}"
             if reason:
@@ -504,15 +2190,9 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 msg_link = f"https://t.me/c/{chat_id_for_link}/{update.message.reply_to_message.message_id}"
                 mute_msg += f"\n🔗 Повідомлення: {msg_link}"
             # Відправляємо адмінам у приват
-            for admin in admins:
-                if admin.user.is_bot:
-                    continue
-                try:
-                    await context.bot.send_message(chat_id=admin.user.id, text=mute_msg)
-                except:
-                    pass  # Якщо не можемо відправити — ігноруємо
+            context.application.create_task(notify_admins(context, chat.id, mute_msg))
         except Exception as e:
-            print(f"Помилка при сповіщенні адмінів: {e}")
+            mute_log.error("Помилка при сповіщенні адмінів: %s", e)
         # Авто-видалення повідомлень
         await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
         # msg (повідомлення бота) не видаляється
@@ -520,6 +2200,33 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await update.message.reply_text(f"Помилка: {e}")
         await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
         # msg (повідомлення бота) не видаляється
+# Скільки приватних сповіщень адмінам надсилаємо одночасно
+ADMIN_NOTIFY_CONCURRENCY = int(os.getenv("ADMIN_NOTIFY_CONCURRENCY", "5"))
+async def notify_admins(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
+    """Розсилає повідомлення адмінам групи в приват, пропускаючи тих, хто заблокував бота"""
+    try:
+        admins = await get_chat_admins(context, chat_id)
+    except Exception as e:
+        mute_log.error("Помилка при сповіщенні адмінів: %s", e)
+        return
+    blocked_admins = context.bot_data.setdefault("blocked_admins", [])
+    semaphore = asyncio.Semaphore(ADMIN_NOTIFY_CONCURRENCY)
+    async def send(admin_id):
+        async with semaphore:
+            try:
+                await context.bot.send_message(chat_id=admin_id, text=text)
+            except Forbidden:
+                # Адмін заблокував бота або не запускав його - більше не намагаємось
+                if admin_id not in blocked_admins:
+                    blocked_admins.append(admin_id)
+                    save_bot_data(context, "settings", ("blocked_admins",))
+            except Exception as e:
+                mute_log.warning("Не вдалося сповістити адміна %s: %s", admin_id, e)
+    await asyncio.gather(*(
+        send(admin_id)
+        for admin_id, admin in admins.items()
+        if not admin.user.is_bot and admin_id not in blocked_admins
+    ))
 # Команда /unmute
 async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /unmute - розмутити користувача"""
@@ -589,7 +2296,7 @@ async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if str(user_to_unmute.user.id) in muted_data:
             del muted_data[str(user_to_unmute.user.id)]
             # Зберігаємо на диск
-            save_bot_data(context)
+            save_bot_data(context, "muted_users", (chat.id, user_to_unmute.user.id))
         unmute_message = f"@{user_to_unmute.user.username or user_to_unmute.user.first_name}, кляп видалено @{admin_user.username or admin_user.first_name}, не змушуй робити це ще раз!"
         msg = await update.message.reply_text(unmute_message)
         # Авто-видалення повідомлень
@@ -623,33 +2330,15 @@ async def sky(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # msg (повідомлення бота) не видаляється
         return
     try:
-        # Отримуємо персоналізацію
-        personality = context.bot_data.get("gemini_personality", "")
-        # Отримуємо історію розмови
-        history = await get_conversation_context(user.id)
-        # Формуємо запит з персоналізацією та історією
-        full_prompt = f"{personality}\n"
-        if history:
-            full_prompt += "Попередня розмова:\n" + "\n".join(history) + "\n"
-        full_prompt += f"Користувач ({await get_user_name(user)}): {message_text}\nАсистент:"
-        # Отримуємо відповідь від Gemini
-        response = model.generate_content(full_prompt)
-        reply_text = response.text.strip()
-        # Зберігаємо крок розмови
-        await save_conversation_step(
-            user_id=user.id,
-            user_message=message_text,
-            bot_response=reply_text,
-            user_name=await get_user_name(user)
-        )
-        msg = await update.message.reply_text(reply_text)
+        # Хід розмови виконується в черзі користувача (послідовно, без гонок історії)
+        await submit_ai_turn(context, update.effective_chat.id, user, update.message, message_text)
         await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
         # msg (повідомлення бота) не видаляється
     except Exception as e:
         error_msg = f"Помилка при зверненні до AI: {str(e)}"
         msg = await update.message.reply_text(error_msg)
         await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
-        print(error_msg)
+        ai_log.error(error_msg)
         # msg (повідомлення бота) не видаляється
 # Команда /my_pepper - показує розмір вашої линейки
 async def my_pepper(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -661,11 +2350,13 @@ async def my_pepper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await schedule_message_deletion(context, chat.id, msg.message_id, 10)
         await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
         return
-    reputations = context.bot_data.get("reputations", {})
-    user_rep_key = f"{chat.id}_{user.id}"
-    current_length = reputations.get(user_rep_key, 0)
+    current_length = reputation_store.get(chat.id, user.id)
     user_name = user.username or user.first_name
-    msg = await update.message.reply_text(f"@{user_name}, ваша линейка {current_length} сантиметрів! 🫡")
+    response_text = f"@{user_name}, ваша линейка {current_length} сантиметрів! 🫡"
+    rank = reputation_store.rank(chat.id, user.id)
+    if rank:
+        response_text += f"\n🏅 Місце в чаті: {rank[0]} з {rank[1]}"
+    msg = await update.message.reply_text(response_text)
     # Запланувати видалення повідомлення з розміром линейки через 10 секунд
     await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
     # msg (повідомлення бота) не видаляється
@@ -680,30 +2371,22 @@ async def pepper_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
         return
 
-    reputations = context.bot_data.get("reputations", {})
-    # Фильтруем репутации только для текущего чата
-    chat_reps = {
-        key.split('_')[1]: length  # Виправлено: використовуємо 'key' замість 'user_id'
-        for key, length in reputations.items()
-        if key.startswith(f"{chat.id}_") and isinstance(length, (int, float))
-    }
-    if not chat_reps:
+    # Топ-3 береться з уже відсортованого рейтингу чату
+    sorted_reps = reputation_store.top(chat.id, 3)
+    if not sorted_reps:
         msg = await update.message.reply_text("У цьому чаті ще немає линеек 😢")
         # Запланувати видалення через 5 хвилин
         await schedule_message_deletion(context, chat.id, msg.message_id, 300)
         await schedule_message_deletion(context, chat.id, update.message.message_id, 10)
         return
 
-    # Сортируем по убыванию длины линейки і берем тільки топ-3
-    sorted_reps = sorted(chat_reps.items(), key=lambda item: item[1], reverse=True)[:3] # Тільки топ-3
     # Формируем текст рейтинга
     leaderboard_lines = ["🏆 Топ 3 Линейки цього чату:"]
     for i, (user_id_str, length) in enumerate(sorted_reps):
         # Пытаемся получить имя пользователя из чата
         try:
-            member = await context.bot.get_chat_member(chat.id, int(user_id_str))
-            user_name = member.user.username or member.user.first_name
-            display_name = f"@{user_name}" if member.user.username else user_name
+            username, first_name = await get_user_identity(context, chat.id, int(user_id_str))
+            display_name = f"@{username}" if username else first_name
         except:
             # Если не удалось получить, отображаем ID
             display_name = f"Користувач {user_id_str}"
@@ -745,15 +2428,10 @@ async def handle_plus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if giver.id == receiver.id:
         return
     # --- Логіка репутації ---
-    # 1. Отримати поточний розмір линейки отримувача
-    reputations = context.bot_data.setdefault("reputations", {})
-    user_rep_key = f"{chat.id}_{receiver.id}"
-    current_length = reputations.get(user_rep_key, 0)
-    # 2. Збільшити на 1
-    new_length = current_length + 1
+    # 1-2. Збільшити линейку отримувача на 1 (рейтинг чату оновлюється тут же)
+    new_length = reputation_store.change(chat.id, receiver.id, 1)
     # 3. Зберегти нове значення
-    reputations[user_rep_key] = new_length
-    save_bot_data(context) # Зберігаємо зміни
+    save_bot_data(context, "reputations", (chat.id, receiver.id)) # Зберігаємо зміни
     # 4. Створити повідомлення
     giver_name = giver.username or giver.first_name
     receiver_name = receiver.username or receiver.first_name
@@ -785,15 +2463,10 @@ async def handle_minus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if giver.id == receiver.id:
         return
     # --- Логіка репутації ---
-    # 1. Отримати поточний розмір линейки отримувача
-    reputations = context.bot_data.setdefault("reputations", {})
-    user_rep_key = f"{chat.id}_{receiver.id}"
-    current_length = reputations.get(user_rep_key, 0)
-    # 2. Зменшити на 1 (але не нижче 0)
-    new_length = max(current_length - 1, 0)
+    # 1-2. Зменшити линейку отримувача на 1 (але не нижче 0)
+    new_length = reputation_store.change(chat.id, receiver.id, -1)
     # 3. Зберегти нове значення
-    reputations[user_rep_key] = new_length
-    save_bot_data(context) # Зберігаємо зміни
+    save_bot_data(context, "reputations", (chat.id, receiver.id)) # Зберігаємо зміни
     # 4. Створити повідомлення
     giver_name = giver.username or giver.first_name
     receiver_name = receiver.username or receiver.first_name
@@ -809,6 +2482,27 @@ async def handle_minus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # msg (повідомлення бота) не видаляється
 # Обробник відповідей на повідомлення бота або згадок
 IGNORED_COMMANDS = {"/mute", "/muty", "/ban", "/alert", "/report", "/date", "/who"}
+# === ФІЛЬТРИ ПОВІДОМЛЕНЬ ===
+# Відсікають звичайні повідомлення ще до виклику обробника (і до створення задачі для block=False)
+class BotMentionFilter(filters.MessageFilter):
+    """Текст містить @username бота"""
+    def filter(self, message):
+        return bool(message.text) and f"@{message.get_bot().username}" in message.text
+class ReplyToBotFilter(filters.MessageFilter):
+    """Відповідь на повідомлення самого бота"""
+    def filter(self, message):
+        replied = message.reply_to_message
+        return bool(replied and replied.from_user and replied.from_user.id == message.get_bot().id)
+class IgnoredCommandFilter(filters.MessageFilter):
+    """Текст починається з команди з IGNORED_COMMANDS (такі повідомлення видаляються)"""
+    def filter(self, message):
+        words = (message.text or "").split(maxsplit=1)
+        return bool(words) and words[0].split('@')[0].lower() in IGNORED_COMMANDS
+bot_mention_filter = BotMentionFilter(name="BotMention")
+reply_to_bot_filter = ReplyToBotFilter(name="ReplyToBot")
+ignored_command_filter = IgnoredCommandFilter(name="IgnoredCommand")
+# Користувачі, від яких чекаємо новий опис персони (після кнопки "Gemini Персона")
+waiting_for_personality = filters.User(allow_empty=False)
 # --- ИСПРАВЛЕННАЯ ФУНКЦИЯ handle_reply_or_mention ---
 async def handle_reply_or_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает прямые упоминания, ответы на сообщения бота и ответы на сообщения участников с упоминанием."""
@@ -871,7 +2565,7 @@ async def handle_reply_or_mention(update: Update, context: ContextTypes.DEFAULT_
         # print("DEBUG: Processing the message...")
         if not GEMINI_API_KEY:
             error_msg = "Gemini API не налаштовано."
-            print(error_msg)
+            ai_log.warning(error_msg)
             error_reply = await update.message.reply_text(error_msg)
             await schedule_message_deletion(context, chat.id, error_reply.message_id, 10)
             # Не удаляем сообщение пользователя, которое он написал боту
@@ -880,47 +2574,34 @@ async def handle_reply_or_mention(update: Update, context: ContextTypes.DEFAULT_
             # Очищаем текст запроса от упоминания бота (если оно было)
             clean_query_text = message_text.replace(f"@{bot_username}", "").strip()
             # print(f"DEBUG: Cleaned query text: '{clean_query_text}'")
-            # Формируем запрос для Gemini
-            personality = context.bot_data.get("gemini_personality", "")
-            history = await get_conversation_context(user.id)
-            # Создаем контекст для ИИ
-            context_for_gemini = f"{personality}\n"
-            if history:
-                context_for_gemini += "Попередня розмова:\n" + "\n".join(history) + "\n"
             # Если это сценарий ответа (на бота или на участника), добавляем контекст
+            reply_context = ""
             if is_reply_scenario and replied_to_text:
                 if is_reply_to_bot:
-                     context_for_gemini += f"[Відповідь на повідомлення бота: {replied_to_text}]\n"
+                     reply_context = f"[Відповідь на повідомлення бота: {replied_to_text}]\n"
                 elif is_reply_to_user_with_mention:
-                     context_for_gemini += f"[Відповідь на повідомлення від {replied_user_name}: {replied_to_text}]\n"
-            # Добавляем запрос пользователя
-            user_name = await get_user_name(user)
-            context_for_gemini += f"Користувач ({user_name}): {clean_query_text}\nАсистент:"
-            # print(f"DEBUG: Final prompt to Gemini:\n{context_for_gemini}\n---END---")
-            # Получаем ответ от Gemini
-            response = model.generate_content(context_for_gemini)
-            reply_text = response.text.strip()
-            # print(f"DEBUG: Gemini response: '{reply_text}'")
-            # Сохраняем шаг разговора
+                     reply_context = f"[Відповідь на повідомлення від {replied_user_name}: {replied_to_text}]\n"
             # Для ответов на участников с упоминанием сохраняем контекст
             user_message_to_save = clean_query_text
             if is_reply_to_user_with_mention and replied_to_text:
                  user_message_to_save = f"[Про повідомлення '{replied_to_text}' від {replied_user_name}] {clean_query_text}"
             elif is_reply_to_bot and replied_to_text:
                  user_message_to_save = f"[Відповідь на '{replied_to_text}'] {clean_query_text}"
-            await save_conversation_step(
-                user_id=user.id,
-                user_message=user_message_to_save,
-                bot_response=reply_text,
-                user_name=user_name
-            )
-            # Отправляем ответ
+            # Запрос к Gemini, ответ (потоково, если включено) и сохранение шага - в очереди пользователя
             # Сообщение бота НЕ удаляется
-            await update.message.reply_text(reply_text)
+            await submit_ai_turn(
+                context,
+                chat.id,
+                user,
+                update.message,
+                clean_query_text,
+                reply_context=reply_context,
+                saved_text=user_message_to_save
+            )
             # Сообщение пользователя НЕ удаляется, так как оно адресовано боту или является продолжением диалога
         except Exception as e:
             error_msg = f"Помилка при зверненні до AI: {str(e)}"
-            print(error_msg) # Логируем ошибку
+            ai_log.error(error_msg)
             # Отправляем сообщение об ошибке
             error_reply = await update.message.reply_text(error_msg)
             await schedule_message_deletion(context, chat.id, error_reply.message_id, 10)
@@ -936,6 +2617,16 @@ async def handle_reply_or_mention(update: Update, context: ContextTypes.DEFAULT_
     # Если не соответствует ни одному критерию, просто игнорируем.
     # print("DEBUG: Message did not match any processing criteria, ignoring.")
     return # Явный return для ясности
+async def get_muted_username(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
+    """Ім'я замученого: з кешу, потім зі списку мутів, і лише тоді через get_chat_member"""
+    cached = user_cache.get(user_id)
+    if cached:
+        return cached[0] or cached[1]
+    muted_entry = context.bot_data.get("muted_users", {}).get(str(chat_id), {}).get(str(user_id))
+    if muted_entry and muted_entry.get("username"):
+        return muted_entry["username"]
+    username, first_name = await get_user_identity(context, chat_id, user_id)
+    return username or first_name
 # Обробник кнопок
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обробляє натискання кнопок"""
@@ -945,12 +2636,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Кнопка "Мути" в /start
     if query.data == "show_groups":
         # Перевірка чи є користувач адміном хоча б в одній групі
-        groups = context.bot_data.get("groups", {})
-        user_groups = []
-        for group_id_str, group_data in groups.items():
-            group_id = int(group_id_str) if isinstance(group_id_str, str) else group_id_str
-            if await is_user_admin(context, group_id, user_id):
-                user_groups.append((group_id, group_data["title"]))
+        user_groups = await get_admin_groups(context, user_id)
         if not user_groups:
             await query.edit_message_text("Я впихну кляп тобі, якщо продовжиш тикати.")
             return
@@ -971,17 +2657,23 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
         # Зберігаємо стан, що очікуємо введення персони
-        context.user_data["waiting_for_personality"] = True
+        waiting_for_personality.add_user_ids(user_id)
         # query.message (повідомлення бота) не видаляється
     # Назад до головного меню
     elif query.data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("Мути 🔇", callback_data="show_groups")],
-            [InlineKeyboardButton("Gemini Персона 🤖", callback_data="gemini_personality")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Привіт! Я бот для управління мутами.", reply_markup=reply_markup)
+        await query.edit_message_text("Привіт! Я бот для управління мутами.", reply_markup=main_menu_markup())
         # query.message (повідомлення бота) не видаляється
+    # Увімкнення/вимкнення профілювання без перезапуску
+    elif query.data == "toggle_profiling":
+        if not await get_admin_groups(context, user_id):
+            await query.edit_message_text("Я впихну кляп тобі, якщо продовжиш тикати.")
+            return
+        profiler.set_enabled(not profiler.enabled)
+        status = (
+            f"Профілювання увімкнено: оновлення довше {PROFILE_SLOW_MS:g} мс записуються у {PROFILE_FILE}."
+            if profiler.enabled else "Профілювання вимкнено."
+        )
+        await query.edit_message_text(f"Привіт! Я бот для управління мутами.\n\n⏱ {status}", reply_markup=main_menu_markup())
     # Обрано групу для перегляду мутів
     elif query.data.startswith("group_mutes_"):
         chat_id = int(query.data.split("_")[-1])
@@ -1018,8 +2710,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("Я впихну кляп тобі, якщо продовжиш тикати.")
             return
         try:
-            user = await context.bot.get_chat_member(chat_id, user_id_to_unmute)
-            username = user.user.username or user.user.first_name
+            username = await get_muted_username(context, chat_id, user_id_to_unmute)
             confirm_button = InlineKeyboardMarkup([
                 [InlineKeyboardButton("✅ Так, зняти кляп", callback_data=f"confirm_unmute_{user_id_to_unmute}_{chat_id}")],
                 [InlineKeyboardButton("❌ Скасувати", callback_data=f"group_mutes_{chat_id}")]])
@@ -1040,8 +2731,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("Я впихну кляп тобі, якщо продовжиш тикати.")
             return
         try:
-            user = await context.bot.get_chat_member(chat_id, user_id_to_unmute)
-            username = user.user.username or user.user.first_name
+            username = await get_muted_username(context, chat_id, user_id_to_unmute)
             admin_username = query.from_user.username or query.from_user.first_name
             await context.bot.restrict_chat_member(
                 chat_id=chat_id,
@@ -1062,7 +2752,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if str(user_id_to_unmute) in muted_data:
                 del muted_data[str(user_id_to_unmute)]
                 # Зберігаємо на диск
-                save_bot_data(context)
+                save_bot_data(context, "muted_users", (chat_id, user_id_to_unmute))
             # Відправляємо повідомлення в групу
             unmute_msg = f"@{username}, кляп видалено @{admin_username}, не змушуй робити це ще раз!"
             await context.bot.send_message(chat_id=chat_id, text=unmute_msg)
@@ -1073,65 +2763,117 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Обробник текстових повідомлень (для введення персони Gemini)
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обробляє текстові повідомлення"""
-    # Якщо очікуємо введення персони
-    if context.user_data.get("waiting_for_personality"):
+    # Сюди потрапляють лише повідомлення з фільтром waiting_for_personality
+    if update.effective_user.id in waiting_for_personality.user_ids:
         personality = update.message.text
         context.bot_data["gemini_personality"] = personality
-        save_bot_data(context)
-        context.user_data["waiting_for_personality"] = False
+        save_bot_data(context, "settings", ("gemini_personality",))
+        # Відповіді старої персони більше не актуальні
+        response_cache.clear()
+        waiting_for_personality.remove_user_ids(update.effective_user.id)
         msg = await update.message.reply_text("Персона оновлена!")
         await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
         # msg (повідомлення бота) не видаляється
         # Показуємо головне меню
-        keyboard = [
-            [InlineKeyboardButton("Мути 🔇", callback_data="show_groups")],
-            [InlineKeyboardButton("Gemini Персона 🤖", callback_data="gemini_personality")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        menu_msg = await update.message.reply_text("Привіт! Я бот для управління мутами.", reply_markup=reply_markup)
+        menu_msg = await update.message.reply_text("Привіт! Я бот для управління мутами.", reply_markup=main_menu_markup())
         await schedule_message_deletion(context, update.effective_chat.id, update.message.message_id, 10)
         # menu_msg (повідомлення бота) не видаляється
 # Відстеження груп через будь-які повідомлення
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Відстежує групи, де бот є"""
+    """Відстежує групи, де бот є, і зміни username власників анкет"""
     chat = update.effective_chat
+    user = update.effective_user
+    user_cache.remember(user)
+    if update.message and update.message.reply_to_message:
+        user_cache.remember(update.message.reply_to_message.from_user)
+    if user:
+        profile_data = context.bot_data.get("profiles", {}).get(str(user.id))
+        if profile_data and profile_data.get("username") != user.username:
+            username_index.update(user.id, profile_data.get("username"), user.username)
+            profile_data["username"] = user.username
+            save_bot_data(context, "profiles", (user.id,))
     if chat and chat.type in ['group', 'supergroup']:
         groups = context.bot_data.setdefault("groups", {})
-        groups[str(chat.id)] = {"title": chat.title or f"Група {chat.id}"}
-        # Зберігаємо при зміні
-        save_bot_data(context)
+        title = chat.title or f"Група {chat.id}"
+        # Зберігаємо тільки при зміні (нова група або нова назва)
+        if groups.get(str(chat.id), {}).get("title") != title:
+            groups[str(chat.id)] = {"title": title}
+            save_bot_data(context, "groups", (chat.id,))
 # --- ИЗМЕНЕНИЯ В main() ---
-def main():
-    """Головна функція бота"""
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+def build_application():
+    """Створює Application з повною таблицею обробників (спільна для main() та loadtest.py)"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Усі send/delete/restrict виклики проходять через спільний обмежувач
+        .rate_limiter(OutboundRateLimiter())
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_URL.rstrip('/')}/file/bot")
+    app = builder.build()
     # Команди для знакомств
-    app.add_handler(CommandHandler("date", date))
-    app.add_handler(CommandHandler("who", who))
+    # Обробники, що відповідають у групи, працюють з block=False: очікування ліміту групи (20 повідомлень/хв)
+    # не зупиняє обробку оновлень з інших чатів, а мути не стоять за чужими відповідями
+    app.add_handler(CommandHandler("date", date, block=False))
+    app.add_handler(CommandHandler("who", who, block=False))
     # Команди для мут-системи
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("muty", muty))
-    app.add_handler(CommandHandler("mute", mute))
-    app.add_handler(CommandHandler("unmute", unmute))
+    app.add_handler(CommandHandler("muty", muty, block=False))
+    app.add_handler(CommandHandler("mute", with_priority(mute, PRIORITY_MODERATION), block=False))
+    app.add_handler(CommandHandler("unmute", with_priority(unmute, PRIORITY_MODERATION), block=False))
     # Команда для AI
-    app.add_handler(CommandHandler("sky", sky))
+    # block=False - відповідь Gemini не блокує обробку інших оновлень (мути, +/-, видалення)
+    app.add_handler(CommandHandler("sky", sky, block=False))
     # Команди для репутації
-    app.add_handler(CommandHandler("my_pepper", my_pepper))
-    app.add_handler(CommandHandler("pepper", pepper_leaderboard))
+    # Відповіді репутації некритичні: поступаються мутам і пропускаються, якщо надто довго чекають ліміту
+    app.add_handler(CommandHandler("my_pepper", with_priority(my_pepper, PRIORITY_COSMETIC), block=False))
+    app.add_handler(CommandHandler("pepper", with_priority(pepper_leaderboard, PRIORITY_COSMETIC), block=False))
     # Обработчики для системы репутации (+/-) - они должны идти после, 
     # так как они обрабатывают специфичные сообщения
-    app.add_handler(MessageHandler(filters.REPLY & filters.Regex(r'^\+$'), handle_plus), group=1) 
-    app.add_handler(MessageHandler(filters.REPLY & filters.Regex(r'^-$'), handle_minus), group=1) 
+    app.add_handler(MessageHandler(filters.REPLY & filters.Regex(r'^\+$'), with_priority(handle_plus, PRIORITY_COSMETIC), block=False), group=1) 
+    app.add_handler(MessageHandler(filters.REPLY & filters.Regex(r'^-$'), with_priority(handle_minus, PRIORITY_COSMETIC), block=False), group=1) 
     # Обработчики
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler), group=2) # group=2, если text_handler должен обрабатывать то, что не поймал handle_reply_or_mention
+    # Кнопки адмін-меню знімають мути (повідомлення в групу) - теж з пріоритетом модерації
+    app.add_handler(CallbackQueryHandler(with_priority(button_handler, PRIORITY_MODERATION), block=False))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & waiting_for_personality, text_handler), group=2) # group=2, если text_handler должен обрабатывать то, что не поймал handle_reply_or_mention
     # === ВАЖНО: Порядок добавления обработчиков ===
     # handle_reply_or_mention должен быть первым или почти первым, 
     # чтобы иметь возможность обработать сообщение до других обработчиков.
     # Используем group=0 (по умолчанию самый высокий приоритет) для этого обработчика.
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reply_or_mention), group=0) 
+    # Фільтр пропускає лише згадки бота, відповіді боту та команди зі списку на видалення
+    app.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND & (bot_mention_filter | reply_to_bot_filter | ignored_command_filter),
+        handle_reply_or_mention,
+        block=False
+    ), group=0)
     # track_chats - отслеживание чатов, должно идти позже
     app.add_handler(MessageHandler(filters.ALL, track_chats), group=3) 
-    print("🟢 Бот запущений!")
-    app.run_polling()
+    # Зміни адмінів скидають кеш прав
+    app.add_handler(ChatMemberHandler(track_chat_members, ChatMemberHandler.ANY_CHAT_MEMBER), group=3)
+    # Затримки та помилки кожного обробника - на /metrics
+    instrument_handlers(app)
+    return app
+def main():
+    """Головна функція бота"""
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook задайте WEBHOOK_URL - публічну HTTPS-адресу, на яку Telegram надсилатиме оновлення")
+    setup_logging()
+    app = build_application()
+    # chat_member оновлення Telegram надсилає лише якщо їх явно запитати
+    if BOT_MODE == "webhook":
+        log.info("Бот запущений (webhook на %s:%s/%s)", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        log.info("Бот запущений")
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 if __name__ == '__main__':
     main()
\ No newline at end of file